@@ -0,0 +1,120 @@
+"""
+Benchmarks for the SAP Web Application
+Run with: python benchmarks.py
+"""
+
+import json
+import os
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import main_combined
+from main_combined import ServiceOrder
+
+ORDER_COUNT = 10000
+
+def legacy_order_dict(service_order):
+    """The plain dict the app passed around before ServiceOrder existed"""
+    return {
+        'service_order': service_order,
+        'part_number': f"MK-{service_order[:3]}-{service_order[-2:]}",
+        'serial_number': f"SN{service_order}",
+        'equipment': f"EQ-{service_order}",
+        'customer': "CUSTOMER NAME",
+        'op_comments': "Service required due to unit failure in field. Customer requested express processing.",
+        'mod_status': "MOD-A Revision 3",
+        'auth_documents': ["AUTH-001", "AUTH-002"],
+        'notifications': ["Z8-001", "Z8-002"],
+        'test_sheets': ["TEST-001"],
+        'found_issues': service_order.endswith('1'),
+    }
+
+def measure_memory(build):
+    """Bytes allocated per order when ORDER_COUNT orders are cached"""
+    orders = [str(40000000 + i) for i in range(ORDER_COUNT)]
+    # Parse JSON like a cache fill does, so strings are not shared literals
+    payloads = [json.dumps(legacy_order_dict(so)) for so in orders]
+    tracemalloc.start()
+    cache = {so: build(json.loads(payload)) for so, payload in zip(orders, payloads)}
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(cache) == ORDER_COUNT
+    return size / ORDER_COUNT
+
+def time_call(func, number=20000):
+    """Microseconds per call"""
+    return timeit.timeit(func, number=number) / number * 1e6
+
+def bench_service_order():
+    data = legacy_order_dict("40012345")
+    order = ServiceOrder.from_dict(data)
+    snapshot = json.dumps(order.to_dict())
+    session_value = order.to_session()
+
+    print(f"Memory per cached order ({ORDER_COUNT} orders)")
+    print(f"  dict:         {measure_memory(lambda d: d):8.0f} bytes")
+    print(f"  ServiceOrder: {measure_memory(ServiceOrder.from_dict):8.0f} bytes")
+
+    print("Serialization time per order")
+    print(f"  dict -> snapshot JSON:          {time_call(lambda: json.dumps(data)):6.2f} us")
+    print(f"  ServiceOrder -> snapshot JSON:  {time_call(lambda: json.dumps(order.to_dict())):6.2f} us")
+    print(f"  snapshot JSON -> dict:          {time_call(lambda: json.loads(snapshot)):6.2f} us")
+    print(f"  snapshot JSON -> ServiceOrder:  {time_call(lambda: ServiceOrder.from_dict(json.loads(snapshot))):6.2f} us")
+    print(f"  ServiceOrder -> session:        {time_call(order.to_session):6.2f} us")
+    print(f"  session -> ServiceOrder:        {time_call(lambda: ServiceOrder.from_session(session_value)):6.2f} us")
+    print(f"  session size, dict:             {len(json.dumps(data)):6d} bytes")
+    print(f"  session size, ServiceOrder:     {len(json.dumps(session_value)):6d} bytes")
+
+class SlowStream:
+    """A log sink that blocks on every write, like a full stdout pipe"""
+    def __init__(self, delay=0.0005):
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+def request_latencies(client, count=500):
+    """Latencies in milliseconds of wizard requests that write log records"""
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        client.post('/process_step', data={'current_step': 3, 'manual_input': f"MK-400-{i}"})
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return latencies
+
+def bench_request_logging():
+    """Request latency with logging going through the queue vs written inline"""
+    os.environ.setdefault("SSOE_LOG_LEVEL", "DEBUG")
+    main_combined.SAP_DATA_CACHE.clear()
+    # The wizard checkpoints every answer; keep the benchmark's runs out of sap_data
+    progress = main_combined.WIZARD_PROGRESS
+    progress_dir = tempfile.TemporaryDirectory()
+    main_combined.WIZARD_PROGRESS = main_combined.WizardProgressStore(progress_dir.name)
+    client = main_combined.app.test_client()
+    client.post('/run_automation', data={'service_order': '40012345'})
+
+    print("Request latency with DEBUG logging (process_step, 500 requests)")
+    try:
+        for sink_label, make_sink in (("file", lambda: tempfile.TemporaryFile('w')),
+                                      ("slow pipe", SlowStream)):
+            for label, asynchronous in (("inline", False), ("queue", True)):
+                sink = make_sink()
+                main_combined.configure_logging(stream=sink, asynchronous=asynchronous)
+                latencies = request_latencies(client)
+                main_combined.stop_logging()
+                print(f"  {sink_label:9} {label:6}: mean {sum(latencies) / len(latencies):6.3f} ms, "
+                      f"p99 {latencies[int(0.99 * (len(latencies) - 1))]:6.3f} ms")
+    finally:
+        main_combined.configure_logging()
+        main_combined.WIZARD_PROGRESS = progress
+        progress_dir.cleanup()
+
+if __name__ == '__main__':
+    bench_service_order()
+    bench_request_logging()
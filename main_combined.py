@@ -3,7 +3,7 @@ Combined SAP Web Application
 This version lets you extract SAP data from the web interface
 """
 
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, Response, g, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory
 import os
 import sys
 import datetime
@@ -11,9 +11,109 @@ import json
 import time
 import platform
 import threading
-import traceback
 import subprocess
 import tempfile
+import heapq
+import itertools
+import collections
+import math
+import signal
+import bisect
+import hashlib
+import hmac
+import random
+import uuid
+import queue
+import atexit
+import logging
+import logging.handlers
+import contextvars
+
+# Correlation ids attached to every log record
+REQUEST_ID = contextvars.ContextVar('request_id', default=None)
+JOB_ID = contextvars.ContextVar('job_id', default=None)
+
+class CorrelationFilter(logging.Filter):
+    """Stamp records with the current request and job ids before they are queued"""
+    def filter(self, record):
+        record.request_id = REQUEST_ID.get()
+        record.job_id = JOB_ID.get()
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    One JSON object per line
+    Structured values passed as extra={'fields': {...}} are merged in.
+    """
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'job_id': getattr(record, 'job_id', None),
+        }
+        # Records that came through the queue already carry this in the message
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+# Listener thread that writes queued log records; see configure_logging
+LOG_LISTENER = None
+
+def configure_logging(stream=None, asynchronous=True):
+    """
+    Send the app's logs through a queue to a background writer thread
+    SSOE_LOG_LEVEL sets the default level and SSOE_LOG_LEVELS overrides it
+    per logger, e.g. "ssoe.extractor.output=DEBUG,ssoe.health=WARNING".
+    asynchronous=False writes on the calling thread (used by benchmarks).
+    """
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        LOG_LISTENER = None
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonLogFormatter())
+    if asynchronous:
+        log_queue = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(log_queue)
+        LOG_LISTENER = logging.handlers.QueueListener(log_queue, output)
+        LOG_LISTENER.start()
+    else:
+        handler = output
+    handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger('ssoe')
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.propagate = False
+    root.setLevel(os.environ.get("SSOE_LOG_LEVEL", "INFO").upper())
+    for setting in os.environ.get("SSOE_LOG_LEVELS", "").split(','):
+        name, _, level = setting.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+def stop_logging():
+    """Flush queued records and stop the writer thread"""
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        LOG_LISTENER = None
+
+configure_logging()
+atexit.register(stop_logging)
+
+log = logging.getLogger('ssoe.web')
+extractor_log = logging.getLogger('ssoe.extractor')
+# Raw extractor stdout/stderr, one record per line
+extractor_output_log = logging.getLogger('ssoe.extractor.output')
+scheduler_log = logging.getLogger('ssoe.scheduler')
+health_log = logging.getLogger('ssoe.health')
+snapshot_log = logging.getLogger('ssoe.snapshots')
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
@@ -29,24 +129,391 @@ SAP_DATA_CACHE = {}
 # Check if we're on Windows (needed for SAP GUI automation)
 IS_WINDOWS = platform.system() == "Windows"
 
+# Time budgets in seconds for each phase of an extraction. The extractor
+# announces phases on stdout and is killed when one runs over its budget.
+SAP_PHASE_BUDGETS = {
+    'connect': float(os.environ.get("SAP_CONNECT_TIMEOUT", "15")),
+    'navigate': float(os.environ.get("SAP_NAVIGATION_TIMEOUT", "20")),
+    'grid': float(os.environ.get("SAP_GRID_TIMEOUT", "20")),
+}
+# End-to-end limit for one extractor process
+SAP_EXTRACTION_DEADLINE = float(os.environ.get("SAP_EXTRACTION_DEADLINE", "60"))
+# How long a request waits for an extraction (queue time included)
+SAP_REQUEST_DEADLINE = float(os.environ.get("SAP_REQUEST_DEADLINE", "45"))
+
+# Extractor processes that are still running, tracked by pid files so the
+# watchdog also finds processes orphaned by a restarted worker
+EXTRACTOR_PID_DIR = os.path.join(SAP_DATA_DIR, ".extractors")
+os.makedirs(EXTRACTOR_PID_DIR, exist_ok=True)
+
+# Version of the ServiceOrder snapshot and session formats
+SERVICE_ORDER_SCHEMA = 2
+
+# Values used when SAP has nothing better (and by the simulation)
+DEFAULT_CUSTOMER = "CUSTOMER NAME"
+DEFAULT_OP_COMMENTS = "Service required due to unit failure in field. Customer requested express processing."
+DEFAULT_MOD_STATUS = "MOD-A Revision 3"
+DEFAULT_AUTH_DOCUMENTS = ("AUTH-001", "AUTH-002")
+DEFAULT_NOTIFICATIONS = ("Z8-001", "Z8-002")
+DEFAULT_TEST_SHEETS = ("TEST-001",)
+
+class ServiceOrder:
+    """
+    Service order data as extracted from SAP (or simulated)
+    Slotted, with common strings interned and document lists stored as
+    tuples, so the many cached copies of the same defaults share memory.
+    to_dict()/from_dict() read and write the snapshot format; to_session()/
+    from_session() use a compact positional list for the cookie session.
+    """
+    # Payload fields, in session order
+    FIELDS = ('service_order', 'part_number', 'serial_number', 'equipment', 'customer',
+              'op_comments', 'mod_status', 'auth_documents', 'notifications', 'test_sheets',
+              'found_issues', 'error')
+    LIST_FIELDS = ('auth_documents', 'notifications', 'test_sheets')
+    # Metadata about where the data came from; not part of the payload
+    META_FIELDS = ('snapshot_id', 'stale_reason', 'snapshot_time')
+    __slots__ = FIELDS + META_FIELDS
+
+    def __init__(self, service_order, part_number=None, serial_number=None, equipment=None,
+                 customer=DEFAULT_CUSTOMER, op_comments=DEFAULT_OP_COMMENTS,
+                 mod_status=DEFAULT_MOD_STATUS, auth_documents=DEFAULT_AUTH_DOCUMENTS,
+                 notifications=DEFAULT_NOTIFICATIONS, test_sheets=DEFAULT_TEST_SHEETS,
+                 found_issues=False, error=None):
+        self.service_order = service_order
+        self.part_number = self._intern(part_number)
+        self.serial_number = serial_number
+        self.equipment = equipment
+        self.customer = self._intern(customer)
+        self.op_comments = self._intern(op_comments)
+        self.mod_status = self._intern(mod_status)
+        self.auth_documents = self._intern_list(auth_documents)
+        self.notifications = self._intern_list(notifications)
+        self.test_sheets = self._intern_list(test_sheets)
+        self.found_issues = bool(found_issues)
+        self.error = error
+        self.snapshot_id = None
+        self.stale_reason = None
+        self.snapshot_time = None
+
+    @staticmethod
+    def _intern(value):
+        return sys.intern(value) if isinstance(value, str) else value
+
+    @staticmethod
+    def _intern_list(values):
+        if values is None:
+            return ()
+        values = tuple(sys.intern(v) if isinstance(v, str) else v for v in values)
+        # Share the default tuples instead of keeping equal copies
+        for default in (DEFAULT_AUTH_DOCUMENTS, DEFAULT_NOTIFICATIONS, DEFAULT_TEST_SHEETS):
+            if values == default:
+                return default
+        return values
+
+    @classmethod
+    def placeholder(cls, service_order, **fields):
+        """An order filled with the default values used when SAP has no data"""
+        fields.setdefault('part_number', f"MK-{service_order[:3]}-{service_order[-2:]}")
+        fields.setdefault('serial_number', f"SN{service_order}")
+        return cls(service_order, **fields)
+
+    @property
+    def stale(self):
+        return self.stale_reason is not None
+
+    def to_dict(self):
+        """The snapshot format (what the extractor writes and the store hashes)"""
+        data = {'schema_version': SERVICE_ORDER_SCHEMA}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if field == 'error' and value is None:
+                continue
+            data[field] = list(value) if field in self.LIST_FIELDS else value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build from a snapshot dict; older snapshots lack the schema_version key"""
+        fields = {field: data[field] for field in cls.FIELDS if field in data}
+        return cls(**fields)
+
+    def to_session(self):
+        """Compact positional form for the cookie session"""
+        values = [SERVICE_ORDER_SCHEMA]
+        for field in self.FIELDS + self.META_FIELDS:
+            value = getattr(self, field)
+            values.append(list(value) if field in self.LIST_FIELDS else value)
+        return values
+
+    @classmethod
+    def from_session(cls, values):
+        """Rebuild from to_session() output; None if it is missing or from another schema"""
+        if isinstance(values, dict):
+            # Sessions from before the record existed held the plain dict
+            return cls.from_dict(values)
+        if not values or values[0] != SERVICE_ORDER_SCHEMA:
+            return None
+        count = len(cls.FIELDS)
+        order = cls(*values[1:count + 1])
+        for field, value in zip(cls.META_FIELDS, values[count + 1:]):
+            setattr(order, field, value)
+        return order
+
+    def summary(self):
+        """The identifying fields, as returned by the JSON endpoints"""
+        return {
+            'service_order': self.service_order,
+            'part_number': self.part_number,
+            'serial_number': self.serial_number,
+            'customer': self.customer
+        }
+
+    def __repr__(self):
+        return f"ServiceOrder({self.service_order!r}, part_number={self.part_number!r}, serial_number={self.serial_number!r})"
+
+# Seconds the extractor gives SAP to draw a screen after Enter or a tab switch
+SAP_SCREEN_WAIT = float(os.environ.get("SAP_SCREEN_WAIT", "1"))
+
+ZIWBN_TABS = "wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL"
+IW32_TABS = "wnd[0]/usr/tabsTABSTRIP"
+ZIWBN_EQUIPMENT_GRIDS = [
+    f"{ZIWBN_TABS}/tabpEQUIPMENT_H/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0233/cntlG_CNTR_HDR_EQUIPMENT/shellcont/shell",
+    # SAP GUI 7.x/10 nests the grid one level deeper
+    f"{ZIWBN_TABS}/tabpEQUIPMENT_H/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0233/cntlG_CNTR_HDR_EQUIPMENT/shellcont[0]/shell",
+]
+
+# Transactions the extractor reads from: the fields the service order may
+# be entered in, the tab strip, and the tab showing when the screen opens
+SAP_TRANSACTIONS = {
+    'ZIWBN': {
+        'order_fields': ["wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB1:SAPLYAFF_ZIWBNGUI:0100/ssubSUB2:SAPLYAFF_ZIWBNGUI:0102/ctxtW_INP_DATA"],
+        'tabstrip': ZIWBN_TABS,
+        'initial_tab': 'SERORDER_H',
+    },
+    'IW32': {
+        'order_fields': [
+            "wnd[0]/usr/ctxtAUFNR",
+            "wnd[0]/usr/ctxtRIWO00-AUFNR",
+            "wnd[0]/usr/ctxtVORG",
+            "wnd[0]/usr/ctxtIW32-AUFNR",
+            "wnd[0]/usr/ctxtCAUFVD-AUFNR",
+        ],
+        'tabstrip': IW32_TABS,
+        'initial_tab': 'T\\01',
+    },
+}
+
+# Where each ServiceOrder field is read, best source first. A source gives
+# its transaction, the tab that must be showing (None for elements outside
+# the tab strip), alternative element ids, and how the element is read:
+# 'text', 'cell' (a column of the first grid row) or 'rows' (a column of
+# every row). A missing 'required' field sends the extractor on to the
+# fallback transactions; other fields only use a fallback it visits anyway.
+# Fields no source fills get 'default', or the ServiceOrder placeholder value.
+EXTRACTION_FIELDS = {
+    'customer': {
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'SERORDER_H', 'read': 'text',
+             'ids': [f"{ZIWBN_TABS}/tabpSERORDER_H/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0211/txtYAFS_ZIWBN_HEADER-SRV_KUNUM"]},
+            {'transaction': 'IW32', 'tab': 'T\\01', 'read': 'text',
+             'ids': [f"{IW32_TABS}/tabpT\\01/ssubSUB_DATA:SAPLIQS0:7235/subCUSTOMER:SAPLIQS0:7280/txtKUAGV-NAME1"]},
+            {'transaction': 'IW32', 'tab': None, 'read': 'text',
+             'ids': ["wnd[0]/usr/ctxtRIWO00-KUNUM"]},
+        ],
+    },
+    'part_number': {
+        'required': True,
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'EQUIPMENT_H', 'read': 'cell', 'column': 'MATNR',
+             'ids': ZIWBN_EQUIPMENT_GRIDS},
+            {'transaction': 'IW32', 'tab': 'T\\01', 'read': 'text',
+             'ids': [f"{IW32_TABS}/tabpT\\01/ssubSUB_DATA:SAPLIQS0:7235/subGENERAL:SAPLIQS0:7212/txtLTAP-MATNR"]},
+            {'transaction': 'IW32', 'tab': None, 'read': 'text',
+             'ids': ["wnd[0]/usr/ctxtRIWO00-MATNR"]},
+            {'transaction': 'IW32', 'tab': 'DESC', 'read': 'text',
+             'ids': [f"{IW32_TABS}/tabpDESC/ssubDETAIL:SAPLITO0:0115/txtITOBJ-MATXT"]},
+        ],
+    },
+    'serial_number': {
+        'required': True,
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'EQUIPMENT_H', 'read': 'cell', 'column': 'SERNR',
+             'ids': ZIWBN_EQUIPMENT_GRIDS},
+            {'transaction': 'IW32', 'tab': 'T\\02', 'read': 'text',
+             'ids': [f"{IW32_TABS}/tabpT\\02/ssubSUB_DATA:SAPLIQS0:7236/subOBJ:SAPLIQS0:7322/txtVIQMEL-SERGE"]},
+            {'transaction': 'IW32', 'tab': 'EQUIPMENT', 'read': 'text',
+             'ids': [f"{IW32_TABS}/tabpEQUIPMENT/ssubDETAIL:SAPLITO0:0115/txtITOB-SERGE"]},
+        ],
+    },
+    'equipment': {
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'EQUIPMENT_H', 'read': 'cell', 'column': 'EQUNR',
+             'ids': ZIWBN_EQUIPMENT_GRIDS},
+        ],
+    },
+    'op_comments': {
+        'default': "No comments found",
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'SERORDER_H', 'read': 'text',
+             'ids': [f"{ZIWBN_TABS}/tabpSERORDER_H/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0211/txtYAFS_ZIWBN_HEADER-COMMENTS"]},
+            {'transaction': 'IW32', 'tab': 'T\\01', 'read': 'text',
+             'ids': [f"{IW32_TABS}/tabpT\\01/ssubSUB_DATA:SAPLIQS0:7235/subGENERAL:SAPLIQS0:7212/txtVIQMEL-QMTXT"]},
+        ],
+    },
+    'mod_status': {
+        'default': "No mod status found",
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'MOD', 'read': 'text',
+             'ids': [f"{ZIWBN_TABS}/tabpMOD/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0215/txtYAFS_ZIWBN_MOD-STATUS"]},
+        ],
+    },
+    'auth_documents': {
+        'default': [],
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'DOCS', 'read': 'rows', 'column': 'DOC_NUM',
+             'ids': [f"{ZIWBN_TABS}/tabpDOCS/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0214/cntlG_CNTR_HDR_DOCS/shellcont/shell"]},
+        ],
+    },
+    'notifications': {
+        'default': [],
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'NOTIF', 'read': 'rows', 'column': 'QMNUM',
+             'ids': [f"{ZIWBN_TABS}/tabpNOTIF/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0213/cntlG_CNTR_HDR_NOTIF/shellcont/shell"]},
+        ],
+    },
+    'test_sheets': {
+        'default': [],
+        'sources': [
+            {'transaction': 'ZIWBN', 'tab': 'TESTS', 'read': 'rows', 'column': 'TEST_NUM',
+             'ids': [f"{ZIWBN_TABS}/tabpTESTS/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0216/cntlG_CNTR_HDR_TESTS/shellcont/shell"]},
+        ],
+    },
+}
+
+def plan_cost(visits):
+    """Screen round trips a list of visits makes, and the time they take at SAP_SCREEN_WAIT each"""
+    navigations = len(visits)
+    tab_selects = sum(1 for visit in visits for group in visit['tabs'] if group['select'])
+    return {
+        'navigations': navigations,
+        'tab_selects': tab_selects,
+        'reads': sum(len(group['reads']) for visit in visits for group in visit['tabs']),
+        # Entering a transaction is two screens: the transaction, then the order
+        'estimated_seconds': round((2 * navigations + tab_selects) * SAP_SCREEN_WAIT, 3),
+    }
+
+def unplanned_cost(fields, transactions):
+    """What reading each field's best source in declaration order would cost"""
+    navigations = tab_selects = reads = 0
+    transaction = tab = None
+    for spec in fields.values():
+        source = spec['sources'][0]
+        if source['transaction'] != transaction:
+            transaction = source['transaction']
+            tab = transactions[transaction]['initial_tab']
+            navigations += 1
+        if source['tab'] is not None and source['tab'] != tab:
+            tab = source['tab']
+            tab_selects += 1
+        reads += 1
+    return {
+        'navigations': navigations,
+        'tab_selects': tab_selects,
+        'reads': reads,
+        'estimated_seconds': round((2 * navigations + tab_selects) * SAP_SCREEN_WAIT, 3),
+    }
+
+def compile_extraction_plan(fields=EXTRACTION_FIELDS, transactions=SAP_TRANSACTIONS):
+    """
+    Turn the field declarations into the visits the extractor makes
+    Reads are grouped by transaction and then by tab, so each transaction is
+    entered once and each tab selected at most once: the tab showing on
+    arrival is read first, then elements outside the tab strip, then the
+    other tabs. Transactions holding a field's best source are visited on
+    every extraction (primary); the rest are fallbacks, entered only for
+    missing required fields. Returns the plan passed to the extractor
+    script, with its cost.
+    """
+    primary_transactions = {spec['sources'][0]['transaction'] for spec in fields.values()}
+    visits = {}
+    for name, spec in fields.items():
+        for rank, source in enumerate(spec['sources']):
+            transaction = source['transaction']
+            if transaction not in visits:
+                initial = transactions[transaction]['initial_tab']
+                visits[transaction] = {initial: [], None: []}
+            read = {'field': name, 'rank': rank, 'read': source['read'], 'ids': list(source['ids'])}
+            if 'column' in source:
+                read['column'] = source['column']
+            visits[transaction].setdefault(source['tab'], []).append(read)
+    
+    plan = {'primary': [], 'fallback': []}
+    for transaction, tabs in visits.items():
+        info = transactions[transaction]
+        groups = [{
+            'tab': tab,
+            'select': None if tab in (None, info['initial_tab']) else f"{info['tabstrip']}/tabp{tab}",
+            'reads': reads,
+        } for tab, reads in tabs.items() if reads]
+        provides = sorted({read['field'] for group in groups for read in group['reads']})
+        plan['primary' if transaction in primary_transactions else 'fallback'].append({
+            'transaction': transaction,
+            'order_fields': info['order_fields'],
+            'tabs': groups,
+            'required': [name for name in provides if fields[name].get('required')],
+        })
+    
+    plan['required'] = [name for name, spec in fields.items() if spec.get('required')]
+    plan['fields'] = {name: {key: spec[key] for key in ('required', 'default') if key in spec}
+                      for name, spec in fields.items()}
+    plan['cost'] = {
+        'primary': plan_cost(plan['primary']),
+        'fallback': plan_cost(plan['fallback']),
+        'unplanned': unplanned_cost(fields, transactions),
+    }
+    return plan
+
+EXTRACTION_PLAN = compile_extraction_plan()
+
+class ExtractionTimeout(Exception):
+    """Raised when an extraction does not finish before its deadline"""
+
+class ExtractionCancelled(Exception):
+    """Raised when an extraction is cancelled before it finishes"""
+
+class ExtractionFailed(Exception):
+    """Raised when an extraction finishes without producing order data"""
+
 class SapExtractor:
     """
     Handles SAP data extraction using a separate process to avoid connection issues
     """
     @staticmethod
-    def extract_data(service_order):
+    def extract_data(service_order, cancel_event=None, profile_label=None):
         """
         Extract data for a service order by running the extractor script
-        Returns the path to the data file
+        Returns the id of the snapshot stored in SNAPSHOT_STORE
+        Raises ExtractionTimeout or ExtractionCancelled if the extractor
+        had to be killed; the SAP session is reset in that case
+        With profile_label set, the extractor samples its own stack and the
+        result is merged into PROFILER under that label
         """
-        # Create a unique filename for this extraction
-        filename = f"so_{service_order}_{int(time.time())}.json"
-        output_path = os.path.join(SAP_DATA_DIR, filename)
+        # Create a unique filename for this extraction; the extractor writes
+        # it to the incoming directory and it is then moved into the store
+        timestamp = int(time.time())
+        filename = f"so_{service_order}_{timestamp}.json"
+        output_path = os.path.join(SNAPSHOT_STORE.incoming_dir, filename)
         
         if not IS_WINDOWS:
-            print(f"Not on Windows, cannot extract real SAP data")
+            extractor_log.warning("Not on Windows, cannot extract real SAP data")
             return None
         
+        run = WIZARD_PROGRESS.active(service_order)
+        if run is not None and run['snapshot_id']:
+            # The run in progress already has data for this order, so this
+            # extraction (a manual refresh, say) repeats work already done
+            WIZARD_PROGRESS.count(service_order, 'duplicate_extractions')
+        
         try:
             # Create a temporary script file for SAP extraction
             script_content = '''
@@ -56,8 +523,215 @@ import platform
 import time
 import traceback
 import json
+import threading
+
+# SAP GUI allows six sessions per connection by default
+SAP_MAX_SESSIONS = 6
+# The web app stops the extraction if one navigation takes longer than this
+SAP_NAVIGATION_BUDGET = float(os.environ.get("SAP_NAVIGATION_TIMEOUT", "20"))
+# How long the main session waits for a speculative fallback visit; half the
+# navigation budget, so there is time left to give up on it and start the
+# fallback visit in the main session before the web app's deadline
+SAP_FALLBACK_WAIT = SAP_NAVIGATION_BUDGET / 2
+# Seconds SAP gets to draw a screen after Enter or a tab switch
+SAP_SCREEN_WAIT = float(os.environ.get("SAP_SCREEN_WAIT", "1"))
 
-def extract_sap_data(service_order, output_file):
+class FieldClaims:
+    \"\"\"
+    Order fields filled in by the reads of an extraction plan
+    A better-ranked source always replaces a worse one, so a value the
+    primary transaction returns wins even when the fallback got there first.
+    \"\"\"
+    def __init__(self, data):
+        self.data = data
+        self.winners = {}
+        self.ranks = {}
+        self.sources = {}
+        self.lock = threading.Lock()
+    
+    def _open(self, key, rank):
+        return key not in self.ranks or rank < self.ranks[key]
+    
+    def wants(self, read):
+        with self.lock:
+            return self._open(read['field'], read['rank'])
+    
+    def claim(self, read, value, source):
+        key = read['field']
+        with self.lock:
+            if value:
+                self.sources.setdefault(key, set()).add(source)
+            if not value or not self._open(key, read['rank']):
+                return False
+            self.data[key] = value
+            self.winners[key] = source
+            self.ranks[key] = read['rank']
+        if not isinstance(value, list):
+            print(f"Found {key.replace('_', ' ')} ({source}): {value}")
+        return True
+    
+    def missing(self, *keys):
+        with self.lock:
+            return [key for key in keys if key not in self.ranks]
+
+def read_element(session, read):
+    \"\"\"Value of the first of the read's element ids that exists, or None\"\"\"
+    for element_id in read['ids']:
+        try:
+            element = session.findById(element_id)
+        except Exception:
+            continue
+        if not element:
+            continue
+        try:
+            if read['read'] == 'cell':
+                return element.getCellValue(0, read['column'])
+            if read['read'] == 'rows':
+                return [element.getCellValue(i, read['column']) for i in range(element.RowCount)]
+            return element.text
+        except Exception as e:
+            print(f"Could not read {read['field']} from {element_id}: {e}")
+    return None
+
+def open_transaction(session, visit, service_order, stop, phases=True):
+    \"\"\"Go to the visit's transaction and enter the service order; False if that failed\"\"\"
+    transaction = visit['transaction']
+    if phases:
+        print("PHASE: navigate")
+    print(f"Navigating to {transaction}...")
+    session.findById("wnd[0]/tbar[0]/okcd").text = "/n" + transaction
+    session.findById("wnd[0]").sendVKey(0)
+    if stop.wait(SAP_SCREEN_WAIT):
+        return False
+    
+    print(f"Entering service order {service_order}...")
+    for field_id in visit['order_fields']:
+        try:
+            field = session.findById(field_id)
+        except Exception:
+            continue
+        if field:
+            field.text = service_order
+            break
+    else:
+        print("Could not find service order input field")
+        return False
+    
+    session.findById("wnd[0]").sendVKey(0)
+    if stop.wait(SAP_SCREEN_WAIT):
+        return False
+    print(f"Navigated to {transaction}")
+    return True
+
+def run_visit(session, visit, service_order, claims, stop, phases=True):
+    \"\"\"Enter one transaction and read its fields tab by tab, skipping tabs with nothing left to read\"\"\"
+    try:
+        if not open_transaction(session, visit, service_order, stop, phases):
+            return
+        if phases:
+            print("PHASE: grid")
+        for group in visit['tabs']:
+            reads = [read for read in group['reads'] if claims.wants(read)]
+            if not reads:
+                continue
+            if group['select']:
+                try:
+                    session.findById(group['select']).select()
+                except Exception as e:
+                    print(f"Could not switch to {group['tab']} tab: {e}")
+                    continue
+                if stop.wait(SAP_SCREEN_WAIT):
+                    return
+                print(f"Switched to {group['tab']} tab")
+            for read in reads:
+                if stop.is_set():
+                    return
+                claims.claim(read, read_element(session, read), visit['transaction'])
+    except Exception as e:
+        print(f"Error with {visit['transaction']} transaction: {e}")
+
+# Guards the second session's id, so only one thread closes it
+SESSION_LOCK = threading.Lock()
+
+def close_session(connection, report):
+    \"\"\"Close the second session recorded in report, if nobody has yet\"\"\"
+    with SESSION_LOCK:
+        session_id = report.pop('session_id', None)
+    if session_id is None:
+        return
+    try:
+        connection.CloseSession(session_id)
+        print(f"SESSION CLOSED: {session_id}")
+    except Exception as e:
+        print(f"Could not close the second SAP session: {e}")
+
+def start_speculation(application, visit, service_order, claims, stop, report):
+    \"\"\"
+    Run a fallback visit in a second session on the same connection, on its
+    own thread, while the main session works through the primary visits
+    The thread records in report how long the visit took; the second
+    session is closed when it finishes or is stopped, and otherwise by the
+    main thread before the extractor exits. Its id is printed as a SESSION
+    line so the web app can close it if the extractor is killed.
+    \"\"\"
+    import pythoncom
+    import win32com.client
+    
+    # COM objects belong to the thread that created them; hand the
+    # scripting engine to the worker through a marshalling stream
+    try:
+        stream = pythoncom.CoMarshalInterThreadInterfaceInStream(pythoncom.IID_IDispatch, application._oleobj_)
+    except Exception as e:
+        print(f"{visit['transaction']} speculation skipped: {e}")
+        report['error'] = str(e)
+        return None
+    
+    def run():
+        pythoncom.CoInitialize()
+        connection = None
+        second = None
+        try:
+            started = time.time()
+            engine = win32com.client.Dispatch(pythoncom.CoGetInterfaceAndReleaseStream(stream, pythoncom.IID_IDispatch))
+            connection = engine.Children(0)
+            count = connection.Children.Count
+            if count >= SAP_MAX_SESSIONS:
+                print(f"{visit['transaction']} speculation skipped: no free SAP session")
+                report['error'] = 'no free session'
+                return
+            
+            connection.Children(0).createSession()
+            while connection.Children.Count <= count:
+                if stop.wait(0.1):
+                    return
+                if time.time() - started > SAP_FALLBACK_WAIT:
+                    raise RuntimeError("second SAP session did not open")
+            second = connection.Children(connection.Children.Count - 1)
+            with SESSION_LOCK:
+                report['session_id'] = second.Id
+            print(f"SESSION: {second.Id}")
+            report['session_seconds'] = round(time.time() - started, 3)
+            
+            visit_started = time.time()
+            run_visit(second, visit, service_order, claims, stop, phases=False)
+            if not stop.is_set():
+                report['fallback_seconds'] = round(time.time() - visit_started, 3)
+                report['finished_at'] = time.time()
+        except Exception as e:
+            print(f"{visit['transaction']} speculation failed: {e}")
+            report['error'] = str(e)
+        finally:
+            if second is not None:
+                if stop.is_set():
+                    print(f"Cancelling {visit['transaction']} navigation in the second session")
+                close_session(connection, report)
+            pythoncom.CoUninitialize()
+    
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    return worker
+
+def extract_sap_data(service_order, output_file, defaults, plan, speculative=False):
     print(f"SAP Data Extractor for Service Order: {service_order}")
     print(f"Output file: {output_file}")
     print("-" * 80)
@@ -71,6 +745,7 @@ def extract_sap_data(service_order, output_file):
         sys.exit(1)
     
     try:
+        print("PHASE: connect")
         print("\\nConnecting to SAP GUI...")
         
         # First try via Dispatch
@@ -131,257 +806,87 @@ def extract_sap_data(service_order, output_file):
         username = info.User
         print(f"Connected as user: {username}")
         
-        # Service order data to collect
-        data = {
-            'service_order': service_order,
-            'part_number': None,
-            'serial_number': None,
-            'customer': None,
-            'op_comments': "Service required due to unit failure in field. Customer requested express processing.",
-            'mod_status': "MOD-A Revision 3",
-            'auth_documents': ["AUTH-001", "AUTH-002"],
-            'notifications': ["Z8-001", "Z8-002"],
-            'test_sheets': ["TEST-001"]
-        }
+        # Service order data to collect, starting from the defaults the
+        # web app passed in (ServiceOrder.placeholder in snapshot format)
+        data = dict(defaults)
+        claims = FieldClaims(data)
+        primary = plan['primary']
+        fallback = plan['fallback']
+        primary_sources = {visit['transaction'] for visit in primary}
+        cost = plan['cost']['primary']
+        print(f"Extraction plan: {cost['navigations']} navigation(s), {cost['tab_selects']} tab switch(es), "
+              f"{cost['reads']} reads")
         
-        # First try ZIWBN transaction
-        try:
-            print("\\nTrying ZIWBN transaction...")
-            
-            # Navigate to ZIWBN
-            print("Navigating to ZIWBN...")
-            session.findById("wnd[0]/tbar[0]/okcd").text = "/nZIWBN"
-            session.findById("wnd[0]").sendVKey(0)
-            time.sleep(1)
-            
-            # Enter service order
-            print(f"Entering service order {service_order}...")
-            input_field = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB1:SAPLYAFF_ZIWBNGUI:0100/ssubSUB2:SAPLYAFF_ZIWBNGUI:0102/ctxtW_INP_DATA")
-            input_field.text = service_order
-            session.findById("wnd[0]").sendVKey(0)
-            time.sleep(1)
-            
-            print("Navigated to ZIWBN")
-            
-            # Get customer number
-            try:
-                customer_field = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpSERORDER_H/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0211/txtYAFS_ZIWBN_HEADER-SRV_KUNUM")
-                if customer_field:
-                    data['customer'] = customer_field.text
-                    print(f"Found customer: {data['customer']}")
-            except Exception as e:
-                print(f"Could not find customer: {e}")
-            
-            # Switch to Equipment tab
-            try:
-                print("Switching to Equipment tab...")
-                equipment_tab = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpEQUIPMENT_H")
-                equipment_tab.select()
-                time.sleep(1)
-                
-                # Try to find equipment grid
-                try:
-                    # First try standard grid
-                    grid = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpEQUIPMENT_H/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0233/cntlG_CNTR_HDR_EQUIPMENT/shellcont/shell")
-                    if grid:
-                        data['part_number'] = grid.getCellValue(0, "MATNR")
-                        data['serial_number'] = grid.getCellValue(0, "SERNR")
-                        print(f"Found part number: {data['part_number']}")
-                        print(f"Found serial number: {data['serial_number']}")
-                except Exception:
-                    # Try version 10 grid
-                    try:
-                        grid = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpEQUIPMENT_H/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0233/cntlG_CNTR_HDR_EQUIPMENT/shellcont[0]/shell")
-                        if grid:
-                            data['part_number'] = grid.getCellValue(0, "MATNR")
-                            data['serial_number'] = grid.getCellValue(0, "SERNR")
-                            print(f"Found part number: {data['part_number']}")
-                            print(f"Found serial number: {data['serial_number']}")
-                    except Exception as e:
-                        print(f"Could not find equipment grid: {e}")
-            except Exception as e:
-                print(f"Could not switch to Equipment tab: {e}")
-                
-        except Exception as e:
-            print(f"Error with ZIWBN transaction: {e}")
+        # A fallback transaction may run alongside in a second session
+        speculation = {'speculated': bool(speculative and fallback), 'needed': False, 'saved_seconds': 0.0}
+        worker = None
+        stop_fallback = threading.Event()
+        started = time.time()
+        if speculation['speculated']:
+            worker = start_speculation(application, fallback[0], service_order, claims, stop_fallback, speculation)
         
-        # If we didn't get part number and serial number from ZIWBN, try IW32
-        if not data['part_number'] or not data['serial_number']:
-            try:
-                print("\\nTrying IW32 transaction...")
-                
-                # Navigate to IW32
-                print("Navigating to IW32...")
-                session.findById("wnd[0]/tbar[0]/okcd").text = "/nIW32"
-                session.findById("wnd[0]").sendVKey(0)
-                time.sleep(1)
-                
-                # Enter service order
-                print(f"Entering service order {service_order}...")
-                
-                # Try different service order fields
-                service_order_fields = [
-                    "wnd[0]/usr/ctxtAUFNR",
-                    "wnd[0]/usr/ctxtRIWO00-AUFNR",
-                    "wnd[0]/usr/ctxtVORG",
-                    "wnd[0]/usr/ctxtIW32-AUFNR",
-                    "wnd[0]/usr/ctxtCAUFVD-AUFNR"
-                ]
-                
-                field_found = False
-                for field_id in service_order_fields:
-                    try:
-                        field = session.findById(field_id)
-                        if field:
-                            field.text = service_order
-                            field_found = True
-                            break
-                    except:
-                        continue
-                
-                if not field_found:
-                    print("Could not find service order input field")
-                else:
-                    # Press Enter
-                    session.findById("wnd[0]").sendVKey(0)
-                    time.sleep(1)
-                    
-                    print("Navigated to IW32")
-                
-                    # Look for part number if not found yet
-                    if not data['part_number']:
-                        part_fields = [
-                            "wnd[0]/usr/tabsTABSTRIP/tabpT\\01/ssubSUB_DATA:SAPLIQS0:7235/subGENERAL:SAPLIQS0:7212/txtLTAP-MATNR",
-                            "wnd[0]/usr/tabsTABSTRIP/tabpDESC/ssubDETAIL:SAPLITO0:0115/txtITOBJ-MATXT",
-                            "wnd[0]/usr/ctxtRIWO00-MATNR"
-                        ]
-                        
-                        for field_id in part_fields:
-                            try:
-                                field = session.findById(field_id)
-                                if field:
-                                    data['part_number'] = field.text
-                                    print(f"Found part number: {data['part_number']}")
-                                    break
-                            except:
-                                continue
-                    
-                    # Look for customer if not found yet
-                    if not data['customer']:
-                        customer_fields = [
-                            "wnd[0]/usr/tabsTABSTRIP/tabpT\\01/ssubSUB_DATA:SAPLIQS0:7235/subCUSTOMER:SAPLIQS0:7280/txtKUAGV-NAME1",
-                            "wnd[0]/usr/ctxtRIWO00-KUNUM"
-                        ]
-                        
-                        for field_id in customer_fields:
-                            try:
-                                field = session.findById(field_id)
-                                if field:
-                                    data['customer'] = field.text
-                                    print(f"Found customer: {data['customer']}")
-                                    break
-                            except:
-                                continue
-                    
-                    # Look for serial number if not found yet
-                    if not data['serial_number']:
-                        # Try to switch to Equipment tab
-                        tab_ids = [
-                            "wnd[0]/usr/tabsTABSTRIP/tabpT\\02",
-                            "wnd[0]/usr/tabsTABSTRIP/tabpEQUIPMENT"
-                        ]
-                        
-                        for tab_id in tab_ids:
-                            try:
-                                tab = session.findById(tab_id)
-                                if tab:
-                                    tab.select()
-                                    time.sleep(1)
-                                    print("Switched to Equipment tab")
-                                    
-                                    # Try to get serial number
-                                    serial_fields = [
-                                        "wnd[0]/usr/tabsTABSTRIP/tabpT\\02/ssubSUB_DATA:SAPLIQS0:7236/subOBJ:SAPLIQS0:7322/txtVIQMEL-SERGE",
-                                        "wnd[0]/usr/tabsTABSTRIP/tabpEQUIPMENT/ssubDETAIL:SAPLITO0:0115/txtITOB-SERGE"
-                                    ]
-                                    
-                                    for field_id in serial_fields:
-                                        try:
-                                            field = session.findById(field_id)
-                                            if field:
-                                                data['serial_number'] = field.text
-                                                print(f"Found serial number: {data['serial_number']}")
-                                                break
-                                        except:
-                                            continue
-                                    
-                                    break
-                            except:
-                                continue
-            except Exception as e:
-                print(f"Error with IW32 transaction: {e}")
-
-        # Extract operator comments from ZIWBN or IW32
-        try:
-            comments_field = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpSERORDER_H/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0211/txtYAFS_ZIWBN_HEADER-COMMENTS")
-            data['op_comments'] = comments_field.text if comments_field else ""
-        except:
-            try:
-                comments_field = session.findById("wnd[0]/usr/tabsTABSTRIP/tabpT\\01/ssubSUB_DATA:SAPLIQS0:7235/subGENERAL:SAPLIQS0:7212/txtVIQMEL-QMTXT")
-                data['op_comments'] = comments_field.text if comments_field else ""
-            except:
-                data['op_comments'] = "No comments found"
-
-        # Extract mod status
-        try:
-            mod_field = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpMOD/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0215/txtYAFS_ZIWBN_MOD-STATUS")
-            data['mod_status'] = mod_field.text if mod_field else "No mod status found"
-        except:
-            data['mod_status'] = "No mod status found"
-
-        # Get authorization documents
-        try:
-            auth_grid = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpDOCS/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0214/cntlG_CNTR_HDR_DOCS/shellcont/shell")
-            data['auth_documents'] = [auth_grid.getCellValue(i, "DOC_NUM") for i in range(auth_grid.RowCount)]
-        except:
-            data['auth_documents'] = []
-
-        # Get notifications (Z8)
-        try:
-            notif_grid = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpNOTIF/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0213/cntlG_CNTR_HDR_NOTIF/shellcont/shell")
-            data['notifications'] = [notif_grid.getCellValue(i, "QMNUM") for i in range(notif_grid.RowCount)]
-        except:
-            data['notifications'] = []
-
-        # Get test sheets
-        try:
-            test_grid = session.findById("wnd[0]/usr/subSUB1:SAPLYAFF_ZIWBNGUI:0011/subSUB2:SAPLYAFF_ZIWBNGUI:0200/subSUB2:SAPLYAFF_ZIWBNGUI:0202/tabsG_HEADER_TBSTRP_CTRL/tabpTESTS/ssubG_IWB_HEADER:SAPLYAFF_ZIWBNGUI:0216/cntlG_CNTR_HDR_TESTS/shellcont/shell")
-            data['test_sheets'] = [test_grid.getCellValue(i, "TEST_NUM") for i in range(test_grid.RowCount)]
-        except:
-            data['test_sheets'] = []
+        for visit in primary:
+            run_visit(session, visit, service_order, claims, threading.Event())
         
-        # Make sure we have values for required fields
-        if not data['part_number']:
-            data['part_number'] = f"MK-{service_order[:3]}-{service_order[-2:]}"
-            print(f"Using default part number: {data['part_number']}")
+        primary_seconds = time.time() - started
+        speculation['primary_seconds'] = round(primary_seconds, 3)
+        # The fallback was needed if the primary transactions on their own left a gap
+        speculation['needed'] = any(not claims.sources.get(key, set()) & primary_sources
+                                    for key in plan['required'])
         
-        if not data['serial_number']:
-            data['serial_number'] = f"SN{service_order}"
-            print(f"Using default serial number: {data['serial_number']}")
+        if worker is not None:
+            if claims.missing(*plan['required']):
+                # Still short, so wait for the speculative fallback visit
+                print("PHASE: navigate")
+                print(f"Waiting for {fallback[0]['transaction']} in the second session...")
+                worker.join(SAP_FALLBACK_WAIT)
+            # Whatever the second session is still doing has lost; stop its navigation
+            stop_fallback.set()
+            if speculation.get('fallback_seconds') is not None:
+                # Done one after the other, the fallback would have started once the primary visits finished
+                sequential = primary_seconds + speculation['fallback_seconds']
+                actual = max(primary_seconds, speculation['finished_at'] - started)
+                speculation['saved_seconds'] = round(sequential - actual, 3) if speculation['needed'] else 0.0
         
-        if not data['customer']:
-            data['customer'] = "CUSTOMER NAME"
-            print(f"Using default customer: {data['customer']}")
+        # Visit the fallback transactions for required fields still missing
+        # (unless the second session already did)
+        if claims.missing(*plan['required']) and speculation.get('fallback_seconds') is None:
+            waited = time.time() - started - primary_seconds
+            fallback_started = time.time()
+            for visit in fallback:
+                if claims.missing(*visit['required']):
+                    print(f"\\nTrying {visit['transaction']} transaction...")
+                    run_visit(session, visit, service_order, claims, threading.Event())
+            speculation['fallback_seconds'] = round(time.time() - fallback_started, 3)
+            if worker is not None:
+                # Speculation failed us; the time spent waiting on it was lost
+                speculation['saved_seconds'] = round(-waited, 3)
+        
+        speculation['winners'] = dict(claims.winners)
+        speculation['fallback_won'] = any(source not in primary_sources for source in claims.winners.values())
+        if worker is not None:
+            worker.join(5)
+            # A worker stuck in a COM call would leave its session open
+            # (and IW32 holding the order) once this process exits
+            close_session(connection, speculation)
+        speculation.pop('finished_at', None)
+        print("SPECULATION: " + json.dumps(speculation))
+        
+        # Make sure we have values for fields no transaction had
+        for key, spec in plan['fields'].items():
+            if claims.missing(key):
+                data[key] = spec['default'] if 'default' in spec else defaults.get(key)
+                print(f"Using default {key.replace('_', ' ')}: {data[key]}")
         
         # Write data to JSON file
         print(f"\\nWriting data to {output_file}...")
         with open(output_file, 'w') as f:
-            json.dump(data, f, indent=2)
+            json.dump(data, f)
         
         print(f"Service order data saved to {output_file}")
         print("\\nExtracted Data:")
         for key, value in data.items():
-            if key not in ['auth_documents', 'notifications', 'test_sheets']:
+            if not isinstance(value, list):
                 print(f"  {key}: {value}")
                 
         return True
@@ -392,21 +897,10 @@ def extract_sap_data(service_order, output_file):
         
         # Try to write a minimal data file with error information
         try:
-            error_data = {
-                'service_order': service_order,
-                'part_number': f"MK-{service_order[:3]}-{service_order[-2:]}",
-                'serial_number': f"SN{service_order}",
-                'customer': "CUSTOMER NAME",
-                'error': str(e),
-                'op_comments': "Service required due to unit failure in field. Customer requested express processing.",
-                'mod_status': "MOD-A Revision 3",
-                'auth_documents': ["AUTH-001", "AUTH-002"],
-                'notifications': ["Z8-001", "Z8-002"],
-                'test_sheets': ["TEST-001"]
-            }
+            error_data = dict(defaults, error=str(e))
             
             with open(output_file, 'w') as f:
-                json.dump(error_data, f, indent=2)
+                json.dump(error_data, f)
             
             print(f"Wrote error information to {output_file}")
         except Exception as e2:
@@ -414,16 +908,79 @@ def extract_sap_data(service_order, output_file):
         
         return False
 
+def start_profile_sampler(profile_file, interval=0.005):
+    \"\"\"Sample the main thread's stack and write folded stacks to profile_file at exit\"\"\"
+    import atexit
+    import collections
+    import threading
+    
+    main_ident = threading.get_ident()
+    stacks = collections.Counter()
+    
+    def dump():
+        with open(profile_file, 'w') as f:
+            for stack, count in list(stacks.items()):
+                f.write(f"{stack} {count}\\n")
+    
+    def sample():
+        taken = 0
+        while True:
+            frame = sys._current_frames().get(main_ident)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stacks[";".join(reversed(names))] += 1
+            taken += 1
+            # Write regularly so a killed extractor still leaves a profile
+            if taken % 200 == 0:
+                dump()
+            time.sleep(interval)
+    
+    threading.Thread(target=sample, daemon=True).start()
+    atexit.register(dump)
+
+def hold_extractor_lock(path):
+    \"\"\"
+    Lock path until this process exits, so the web app knows the GUI is in
+    use even if the worker that started this extractor is gone
+    \"\"\"
+    handle = open(path, 'a+')
+    if os.name == 'nt':
+        import msvcrt
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+    return handle
+
 # Main function
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python sap_extractor.py SERVICE_ORDER OUTPUT_FILE")
+    if len(sys.argv) < 5:
+        print("Usage: python sap_extractor.py SERVICE_ORDER OUTPUT_FILE DEFAULTS_JSON PLAN_JSON")
         sys.exit(1)
     
     service_order = sys.argv[1]
     output_file = sys.argv[2]
+    defaults = json.loads(sys.argv[3])
+    # Compiled by the web app from EXTRACTION_FIELDS
+    plan = json.loads(sys.argv[4])
+    
+    # Set by the web app; the OS releases the lock when this process exits
+    if os.environ.get("SSOE_EXTRACTOR_LOCK"):
+        extractor_lock = hold_extractor_lock(os.environ["SSOE_EXTRACTOR_LOCK"])
     
-    success = extract_sap_data(service_order, output_file)
+    # Set by the web app when the request behind this extraction is profiled
+    if os.environ.get("SSOE_PROFILE_FILE"):
+        start_profile_sampler(os.environ["SSOE_PROFILE_FILE"])
+    
+    # Set by the web app for order prefixes where ZIWBN is often incomplete
+    speculative = os.environ.get("SSOE_SPECULATE_IW32") == "1"
+    
+    success = extract_sap_data(service_order, output_file, defaults, plan, speculative)
     sys.exit(0 if success else 1)
 '''
 
@@ -432,278 +989,1645 @@ if __name__ == "__main__":
             with open(script_file, 'w') as f:
                 f.write(script_content)
             
-            print(f"Running SAP extraction script for service order {service_order}")
+            extractor_log.info("Running SAP extraction script for service order %s", service_order,
+                               extra={'fields': {'service_order': service_order}})
+            
+            env = dict(os.environ)
+            profile_file = None
+            if profile_label:
+                profile_file = os.path.join(tempfile.gettempdir(), f"ssoe_profile_{service_order}_{timestamp}.txt")
+                env['SSOE_PROFILE_FILE'] = profile_file
+            if SAP_SPECULATION.should_speculate(service_order):
+                env['SSOE_SPECULATE_IW32'] = "1"
+            
+            # An extractor left behind by a lost worker may still be driving
+            # the GUI; wait for it to exit (or the watchdog to kill it) and
+            # clean up after it before starting another
+            EXTRACTOR_LOCK.acquire(cancel_event)
+            EXTRACTOR_LOCK.release()
+            EXTRACTION_WATCHDOG.reset_orphans()
+            env['SSOE_EXTRACTOR_LOCK'] = EXTRACTOR_LOCK.path
             
-            # Run the script in a separate process
+            # Run the script in a separate process, unbuffered so phase
+            # markers arrive as soon as they are printed
             process = subprocess.Popen(
-                [sys.executable, script_file, service_order, output_path],
+                [sys.executable, "-u", script_file, service_order, output_path,
+                 json.dumps(ServiceOrder.placeholder(service_order).to_dict()),
+                 json.dumps(EXTRACTION_PLAN)],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                text=True
+                text=True,
+                env=env
             )
             
-            # Get output and error
-            stdout, stderr = process.communicate()
+            started = time.time()
+            deadline = started + SAP_EXTRACTION_DEADLINE
+            SapExtractor._register_process(process.pid, deadline)
+            
+            # Stream output into the log on reader threads, so lines show up
+            # as they happen and the deadlines can be checked meanwhile
+            phase = {'name': 'connect', 'started': started}
+            speculation = {}
+            # Extra SAP sessions the extractor opened and has not closed yet
+            sessions = []
+            output_fields = {'service_order': service_order, 'pid': process.pid}
+            
+            def read_stdout():
+                for line in process.stdout:
+                    line = line.rstrip()
+                    if line.startswith("PHASE: "):
+                        phase['name'] = line[7:].strip()
+                        phase['started'] = time.time()
+                    elif line.startswith("SPECULATION: "):
+                        try:
+                            speculation.update(json.loads(line[13:]))
+                        except ValueError:
+                            pass
+                    elif line.startswith("SESSION: "):
+                        sessions.append(line[9:].strip())
+                        # Let the watchdog close it too if this worker is lost
+                        SapExtractor._register_process(process.pid, deadline, sessions)
+                    elif line.startswith("SESSION CLOSED: "):
+                        if line[16:].strip() in sessions:
+                            sessions.remove(line[16:].strip())
+                    if line:
+                        extractor_output_log.info(line, extra={'fields': dict(output_fields, stream='stdout')})
+            
+            def read_stderr():
+                for line in process.stderr:
+                    line = line.rstrip()
+                    if line:
+                        extractor_output_log.warning(line, extra={'fields': dict(output_fields, stream='stderr')})
+            
+            # Threads don't inherit context variables, so hand them the
+            # request and job ids explicitly
+            readers = [threading.Thread(target=contextvars.copy_context().run, args=(read_stdout,), daemon=True),
+                       threading.Thread(target=contextvars.copy_context().run, args=(read_stderr,), daemon=True)]
+            for reader in readers:
+                reader.start()
             
-            # Log the output
-            print(f"SAP Extraction Output:")
-            print(stdout)
+            failure = None
+            try:
+                while process.poll() is None:
+                    now = time.time()
+                    budget = SAP_PHASE_BUDGETS.get(phase['name'], SAP_EXTRACTION_DEADLINE)
+                    if cancel_event is not None and cancel_event.is_set():
+                        failure = ExtractionCancelled(f"Extraction of {service_order} was cancelled")
+                    elif now > deadline:
+                        failure = ExtractionTimeout(
+                            f"Extraction of {service_order} exceeded {SAP_EXTRACTION_DEADLINE:.0f}s")
+                    elif now - phase['started'] > budget:
+                        failure = ExtractionTimeout(
+                            f"Extraction of {service_order} exceeded the {budget:.0f}s "
+                            f"budget for the {phase['name']} phase")
+                    if failure is not None:
+                        SapExtractor._kill(process)
+                        break
+                    try:
+                        process.wait(timeout=0.25)
+                    except subprocess.TimeoutExpired:
+                        pass
+            finally:
+                SapExtractor._unregister_process(process.pid)
+            
+            for reader in readers:
+                reader.join(timeout=1)
+            
+            if profile_file:
+                PROFILER.merge_folded_file(profile_file, f"{profile_label};[extractor]")
             
-            if stderr:
-                print(f"SAP Extraction Errors:")
-                print(stderr)
+            duration = round(time.time() - started, 3)
+            if failure is None and sessions:
+                # The extractor died without closing its second session
+                extractor_log.warning("SAP extractor left session(s) open: %s", ", ".join(sessions),
+                                      extra={'fields': output_fields})
+                SapExtractor.reset_session(sessions)
+            if failure is not None:
+                extractor_log.warning("Stopped SAP extractor: %s", failure,
+                                      extra={'fields': dict(output_fields, phase=phase['name'], duration=duration)})
+                SapExtractor.reset_session(sessions)
+                # A half-written file must not be picked up as a snapshot
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                raise failure
             
             # Check if the process was successful
             if process.returncode == 0 and os.path.exists(output_path):
-                print(f"SAP data extracted successfully to {output_path}")
-                return output_path
+                snapshot_id = SNAPSHOT_STORE.ingest(output_path, service_order, timestamp)
+                SNAPSHOT_INDEX.refresh()
+                if speculation:
+                    SAP_SPECULATION.record(service_order, speculation)
+                extractor_log.info("SAP data extracted successfully to %s", snapshot_id,
+                                   extra={'fields': dict(output_fields, snapshot_id=snapshot_id, duration=duration)})
+                return snapshot_id
             else:
-                print(f"Failed to extract SAP data")
+                extractor_log.warning("Failed to extract SAP data",
+                                      extra={'fields': dict(output_fields, returncode=process.returncode,
+                                                            duration=duration)})
+                # The extractor writes its error details there; they are in the log now
+                if os.path.exists(output_path):
+                    os.remove(output_path)
                 return None
                 
+        except (ExtractionTimeout, ExtractionCancelled):
+            raise
         except Exception as e:
-            print(f"Error running SAP extractor: {e}")
-            print(traceback.format_exc())
+            extractor_log.exception("Error running SAP extractor: %s", e)
             return None
 
-def get_service_order_data(service_order):
-    """
-    Get service order data for the specified service order
-    First tries to extract from SAP, then looks for existing files,
-    and falls back to simulation if necessary
-    """
-    # Check cache first
-    if service_order in SAP_DATA_CACHE:
-        return SAP_DATA_CACHE[service_order]
-    
-    # Look for existing files for this service order
-    existing_files = []
-    for filename in os.listdir(SAP_DATA_DIR):
-        if filename.startswith(f"so_{service_order}_") and filename.endswith(".json"):
-            file_path = os.path.join(SAP_DATA_DIR, filename)
-            existing_files.append((file_path, os.path.getmtime(file_path)))
-    
-    # Sort by modification time (newest first)
-    existing_files.sort(key=lambda x: x[1], reverse=True)
-    
-    # If we have existing files, use the newest one
-    if existing_files:
-        newest_file = existing_files[0][0]
+    @staticmethod
+    def _kill(process):
+        """Kill an extractor process and wait for it to exit"""
         try:
-            with open(newest_file, 'r') as f:
-                data = json.load(f)
-                print(f"Using existing data from {newest_file}")
-                
-                # Cache the data
-                SAP_DATA_CACHE[service_order] = data
-                return data
+            process.kill()
+            process.wait(timeout=5)
         except Exception as e:
-            print(f"Error reading existing data file: {e}")
-    
-    # If we're on Windows, try to extract from SAP
+            extractor_log.error("Error killing SAP extractor %s: %s", process.pid, e)
+
+    @staticmethod
+    def _register_process(pid, deadline, sessions=()):
+        try:
+            with open(os.path.join(EXTRACTOR_PID_DIR, f"{pid}.json"), 'w') as f:
+                json.dump({'pid': pid, 'deadline': deadline, 'started': process_start_time(pid),
+                           'sessions': list(sessions)}, f)
+        except Exception as e:
+            extractor_log.error("Error registering SAP extractor %s: %s", pid, e)
+
+    @staticmethod
+    def _unregister_process(pid):
+        try:
+            os.remove(os.path.join(EXTRACTOR_PID_DIR, f"{pid}.json"))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def reset_session(extra_sessions=()):
+        """
+        Return the SAP session to a clean state after a killed extraction
+        Closes the extra sessions the extractor opened (by id, so sessions
+        the user opened are left alone), then dismisses any popup windows in
+        the first session and sends /n to leave the transaction
+        """
+        if not IS_WINDOWS:
+            return False
+        
+        reset_script = '''
+import sys
+import json
+import win32com.client
+application = win32com.client.GetObject("SAPGUI").GetScriptingEngine
+connection = application.Children(0)
+for session_id in json.loads(sys.argv[1]):
+    try:
+        connection.CloseSession(session_id)
+    except Exception as e:
+        print(f"Could not close {session_id}: {e}")
+session = connection.Children(0)
+for wnd in range(5, 0, -1):
+    try:
+        session.findById(f"wnd[{wnd}]").sendVKey(12)
+    except Exception:
+        pass
+session.findById("wnd[0]/tbar[0]/okcd").text = "/n"
+session.findById("wnd[0]").sendVKey(0)
+'''
+        try:
+            result = subprocess.run([sys.executable, "-c", reset_script, json.dumps(list(extra_sessions))],
+                                    capture_output=True, text=True, timeout=10)
+            if result.returncode != 0:
+                extractor_log.error("Failed to reset SAP session: %s", result.stderr)
+            return result.returncode == 0
+        except Exception as e:
+            extractor_log.error("Error resetting SAP session: %s", e)
+            return False
+
+def process_start_time(pid):
+    """
+    When a process started, in the OS's own units, so a pid can be told
+    apart from a later process that reused it; None if the process is gone
+    or this platform can't say
+    """
     if IS_WINDOWS:
-        data_file = SapExtractor.extract_data(service_order)
-        if data_file:
+        import ctypes
+        from ctypes import wintypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return None
+        try:
+            created, exited, kernel, user = (wintypes.FILETIME() for _ in range(4))
+            if not kernel32.GetProcessTimes(handle, ctypes.byref(created), ctypes.byref(exited),
+                                            ctypes.byref(kernel), ctypes.byref(user)):
+                return None
+            return (created.dwHighDateTime << 32) | created.dwLowDateTime
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            # Field 22, counted after the parenthesised command name
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+class ExtractionWatchdog:
+    """
+    Kills extractor processes that outlive their deadline
+    The extractor supervisor normally does this itself; the watchdog catches
+    processes whose supervisor is stuck or was lost with a restarted worker.
+    Resetting the GUI after them is only done while holding SAP_GUI_LOCK,
+    so it never happens underneath another worker's extraction; if the lock
+    is busy, the next extraction does it before it starts.
+    """
+    GRACE = 10  # Seconds past the deadline before the watchdog steps in
+    LOCK_TIMEOUT = 5  # Seconds the watchdog waits for the GUI to clean up
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.killed = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sap-watchdog", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
             try:
-                with open(data_file, 'r') as f:
-                    data = json.load(f)
-                    print(f"Using freshly extracted data from {data_file}")
-                    
-                    # Cache the data
-                    SAP_DATA_CACHE[service_order] = data
-                    return data
+                self.sweep()
             except Exception as e:
-                print(f"Error reading extracted data file: {e}")
-    
-    # Fall back to simulation
-    return simulate_service_order_data(service_order)
+                extractor_log.exception("Error in SAP extractor watchdog: %s", e)
+            time.sleep(self.interval)
 
-def simulate_service_order_data(service_order):
-    """Simulate service order data"""
-    print(f"Simulating data for service order: {service_order}")
-    
-    # Create a realistic looking but fake data set
-    data = {
-        'service_order': service_order,
-        'part_number': f"MK-{service_order[:3]}-{service_order[-2:]}",
-        'serial_number': f"SN{service_order}",
-        'equipment': f"EQ-{service_order}",
-        'customer': "CUSTOMER NAME",
-        'op_comments': "Service required due to unit failure in field. Customer requested express processing.",
-        'mod_status': "MOD-A Revision 3",
-        'auth_documents': ["AUTH-001", "AUTH-002"],
-        'notifications': ["Z8-001", "Z8-002"],
-        'test_sheets': ["TEST-001"],
-        'found_issues': service_order.endswith('1'),  # Some orders will have issues for testing
-    }
-    
-    # Cache this data
-    SAP_DATA_CACHE[service_order] = data
-    return data
+    @staticmethod
+    def _entries():
+        for filename in os.listdir(EXTRACTOR_PID_DIR):
+            path = os.path.join(EXTRACTOR_PID_DIR, filename)
+            try:
+                with open(path, 'r') as f:
+                    yield path, json.load(f)
+            except Exception:
+                continue
 
-# Global context processor to add date to all templates
-@app.context_processor
-def inject_now():
-    # Check if we're on Windows (can potentially extract SAP data)
-    if IS_WINDOWS:
-        sap_mode = "SAP Data Extraction Enabled"
-    else:
-        sap_mode = "Simulation Mode (Not Windows)"
-    
-    return {
-        'now': datetime.datetime.now().strftime('%Y-%m-%d'),
-        'sap_mode': sap_mode
-    }
+    @staticmethod
+    def _alive(entry):
+        # A pid file left by a lost worker can outlive its process, and
+        # the pid may since have been given to something else entirely
+        started = process_start_time(entry['pid'])
+        return started is not None and started == entry.get('started')
 
-@app.route('/')
-def index():
-    """Render the main web interface"""
-    # Check if we're on Windows (can potentially extract SAP data)
-    if IS_WINDOWS:
-        sap_status = "SAP Data Extraction Enabled"
-    else:
-        sap_status = "Simulation Mode (Not Windows)"
-    
-    # Check for existing data files
-    data_files = []
-    if os.path.exists(SAP_DATA_DIR):
-        for filename in os.listdir(SAP_DATA_DIR):
-            if filename.startswith("so_") and filename.endswith(".json"):
-                file_path = os.path.join(SAP_DATA_DIR, filename)
+    def sweep(self):
+        """Kill every registered extractor that is past its deadline, then clean up after dead ones"""
+        now = time.time()
+        leftovers = False
+        for path, entry in self._entries():
+            if self._alive(entry):
+                if now < entry['deadline'] + self.GRACE:
+                    continue
+                extractor_log.warning("Watchdog killing stuck SAP extractor %s", entry['pid'])
                 try:
-                    file_stat = os.stat(file_path)
-                    modified = datetime.datetime.fromtimestamp(file_stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
-                    
-                    # Parse the service order from the filename
-                    # Format: so_SERVICEORDER_TIMESTAMP.json
-                    parts = filename.split('_')
-                    if len(parts) >= 3:
-                        service_order = parts[1]
-                        
-                        # Read the file to get more details
-                        with open(file_path, 'r') as f:
-                            data = json.load(f)
-                            
-                        data_files.append({
-                            'filename': filename,
-                            'path': file_path,
-                            'modified': modified,
-                            'service_order': service_order,
-                            'part_number': data.get('part_number', 'Unknown'),
-                            'serial_number': data.get('serial_number', 'Unknown')
-                        })
-                except Exception as e:
-                    print(f"Error reading file {file_path}: {e}")
-    
-    # Sort by modification time (newest first)
-    data_files.sort(key=lambda x: x['modified'], reverse=True)
-    
-    return render_template('index.html', 
-                          sap_status=sap_status,
-                          is_windows=IS_WINDOWS,
-                          data_files=data_files[:5])  # Show up to 5 most recent files
+                    os.kill(entry['pid'], signal.SIGTERM)
+                    self.killed += 1
+                except OSError:
+                    pass  # Already gone
+            leftovers = True
+        
+        if leftovers and SAP_GUI_LOCK.acquire(timeout=self.LOCK_TIMEOUT):
+            try:
+                self.reset_orphans()
+            finally:
+                SAP_GUI_LOCK.release()
 
-@app.route('/sap_status')
-def sap_status():
-    """Check SAP data status"""
-    # Count available data files
-    data_file_count = 0
-    if os.path.exists(SAP_DATA_DIR):
-        data_file_count = len([f for f in os.listdir(SAP_DATA_DIR) if f.endswith('.json')])
-    
-    if IS_WINDOWS:
-        return jsonify({
-            'status': 'enabled',
-            'message': 'YEP',
-            'data_files': data_file_count
-        })
-    else:
-        return jsonify({
-            'status': 'simulation',
-            'message': 'Simulation Mode (Not Windows)',
-            'data_files': data_file_count
-        })
+    def reset_orphans(self):
+        """
+        Reset the GUI after extractors that exited without their worker
+        cleaning up; the caller must hold SAP_GUI_LOCK
+        """
+        for path, entry in self._entries():
+            if self._alive(entry):
+                continue
+            extractor_log.info("Cleaning up after lost SAP extractor %s", entry['pid'])
+            SapExtractor.reset_session(entry.get('sessions', []))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
-@app.route('/run_automation', methods=['POST'])
-def run_automation():
-    """Handle the form submission to start automation"""
-    service_order = request.form.get('service_order', '')
-    if not service_order:
-        return redirect(url_for('index', error='Please enter a service order number'))
+EXTRACTION_WATCHDOG = ExtractionWatchdog()
+if IS_WINDOWS:
+    EXTRACTION_WATCHDOG.start()
 
-    # Add a small delay to ensure the spinner is visible
-    time.sleep(1)
-    
-    # Store the service order number in session for the wizard
-    session['service_order'] = service_order
-    
-    # Set SAP mode based on platform
-    session['sap_mode'] = 'extraction' if IS_WINDOWS else 'simulation'
-    
-    # Try to get the service order data (this will extract from SAP if possible)
-    try:
-        order_data = get_service_order_data(service_order)
+# Leading digits of the order number shared by orders of the same type
+SAP_SPECULATION_PREFIX = int(os.environ.get("SAP_SPECULATION_PREFIX", "3"))
+# Share of recent orders needing IW32 above which IW32 runs alongside ZIWBN
+SAP_SPECULATION_THRESHOLD = float(os.environ.get("SAP_SPECULATION_THRESHOLD", "0.3"))
+
+class SpeculationAdvisor:
+    """
+    Learns per order prefix how often ZIWBN leaves the part or serial number
+    empty, and so whether the extractor should look them up in IW32 in a
+    second session at the same time
+    The need rate is a moving average, so a prefix whose orders stop needing
+    IW32 soon stops taking a second session. Latency saved is totalled from
+    the extractor's SPECULATION reports.
+    """
+    ALPHA = 0.2  # Weight of the newest extraction in the need rate
+    MIN_SAMPLES = 3  # Extractions of a prefix seen before it may speculate
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.prefixes = {}
+        try:
+            with open(path, 'r') as f:
+                self.prefixes = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            extractor_log.error("Error loading IW32 speculation stats: %s", e)
+
+    @staticmethod
+    def prefix(service_order):
+        return service_order[:SAP_SPECULATION_PREFIX]
+
+    def should_speculate(self, service_order):
+        with self._lock:
+            stats = self.prefixes.get(self.prefix(service_order))
+        return (stats is not None and stats['orders'] >= self.MIN_SAMPLES
+                and stats['need_rate'] >= SAP_SPECULATION_THRESHOLD)
+
+    def record(self, service_order, report):
+        """Learn from the SPECULATION report of one extraction"""
+        prefix = self.prefix(service_order)
+        needed = bool(report.get('needed'))
+        with self._lock:
+            stats = self.prefixes.setdefault(prefix, {
+                'orders': 0, 'need_rate': 0.0, 'speculated': 0, 'wasted': 0,
+                'iw32_wins': 0, 'saved_seconds': 0.0,
+            })
+            stats['orders'] += 1
+            if stats['orders'] == 1:
+                stats['need_rate'] = float(needed)
+            else:
+                stats['need_rate'] = round((1 - self.ALPHA) * stats['need_rate'] + self.ALPHA * needed, 4)
+            if report.get('speculated'):
+                stats['speculated'] += 1
+                if not needed:
+                    stats['wasted'] += 1
+                stats['saved_seconds'] = round(stats['saved_seconds'] + report.get('saved_seconds', 0.0), 3)
+            if report.get('fallback_won'):
+                stats['iw32_wins'] += 1
+            self._save()
         
-        if not order_data:
-            # Service order not found
-            return redirect(url_for('index', error=f'Service order {service_order} not found'))
+        extractor_log.info("IW32 speculation for %s: needed=%s, saved %.3fs", service_order, needed,
+                           report.get('saved_seconds', 0.0),
+                           extra={'fields': dict(report, service_order=service_order, prefix=prefix)})
+
+    def _save(self):
+        try:
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.prefixes, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            extractor_log.error("Error saving IW32 speculation stats: %s", e)
+
+    def stats(self):
+        """Per-prefix need rates and latency saved, for /speculation_stats"""
+        with self._lock:
+            prefixes = {prefix: dict(stats,
+                                     speculating=(stats['orders'] >= self.MIN_SAMPLES
+                                                  and stats['need_rate'] >= SAP_SPECULATION_THRESHOLD),
+                                     avg_saved_seconds=round(stats['saved_seconds'] / stats['speculated'], 3)
+                                     if stats['speculated'] else 0.0)
+                        for prefix, stats in self.prefixes.items()}
+        return {
+            'prefix_length': SAP_SPECULATION_PREFIX,
+            'threshold': SAP_SPECULATION_THRESHOLD,
+            'speculated': sum(stats['speculated'] for stats in prefixes.values()),
+            'wasted': sum(stats['wasted'] for stats in prefixes.values()),
+            'saved_seconds': round(sum(stats['saved_seconds'] for stats in prefixes.values()), 3),
+            'prefixes': prefixes,
+        }
+
+SAP_SPECULATION = SpeculationAdvisor(os.path.join(SAP_DATA_DIR, "speculation.json"))
+
+# Seconds between background SAP health probes
+SAP_PROBE_INTERVAL = float(os.environ.get("SAP_PROBE_INTERVAL", "10"))
+# Failed probes in a row before extractions are skipped
+SAP_BREAKER_THRESHOLD = int(os.environ.get("SAP_BREAKER_THRESHOLD", "2"))
+# Seconds a status stream stays open before the browser is told to reconnect,
+# so a page left open does not hold a server worker for good
+SAP_STATUS_STREAM_SECONDS = float(os.environ.get("SAP_STATUS_STREAM_SECONDS", "30"))
+# Status streams each hold a server thread; pages beyond this many per
+# worker process fetch /sap_status once instead
+SAP_STATUS_STREAM_LIMIT = int(os.environ.get("SAP_STATUS_STREAM_LIMIT", "2"))
+SAP_STATUS_STREAMS = threading.BoundedSemaphore(SAP_STATUS_STREAM_LIMIT)
+
+class SapUnavailable(Exception):
+    """Raised instead of attempting an extraction while SAP is known to be down"""
+
+class SapHealthProber:
+    """
+    Checks the SAP GUI in the background and caches the result
+    Status requests read the cached state, and listeners (the SSE stream)
+    are woken whenever the status changes. Repeated probe failures open a
+    circuit breaker so extractions fail fast until SAP comes back.
+    """
+    PROBE_SCRIPT = '''
+import json
+import win32com.client
+result = {'engine': False, 'connections': 0, 'sessions': 0, 'user': None}
+try:
+    application = win32com.client.GetObject("SAPGUI").GetScriptingEngine
+    result['engine'] = application is not None
+    result['connections'] = application.Children.Count
+    if result['connections']:
+        connection = application.Children(0)
+        result['sessions'] = connection.Children.Count
+        if result['sessions']:
+            result['user'] = connection.Children(0).Info.User
+except Exception as e:
+    result['error'] = str(e)
+print(json.dumps(result))
+'''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.failures = 0
+        self.version = 0
+        self.state = {
+            'status': 'initializing' if IS_WINDOWS else 'simulation',
+            'message': 'Checking SAP connection' if IS_WINDOWS else 'Simulation Mode (Not Windows)',
+            'connections': 0,
+            'sessions': 0,
+            'user': None,
+            'data_files': 0,
+            'breaker_open': False,
+            'checked_at': None,
+        }
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Start the probe thread (once per worker process)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sap-health", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.probe()
+            except Exception as e:
+                health_log.exception("Error probing SAP status: %s", e)
+            time.sleep(self.interval)
+
+    def _probe_sap(self):
+        """Ask a short-lived process about the SAP GUI; None if it could not tell"""
+        try:
+            result = subprocess.run([sys.executable, "-c", self.PROBE_SCRIPT],
+                                    capture_output=True, text=True,
+                                    timeout=max(5, self.interval))
+            return json.loads(result.stdout.strip().splitlines()[-1])
+        except Exception as e:
+            return {'engine': False, 'connections': 0, 'sessions': 0, 'user': None, 'error': str(e)}
+
+    def probe(self):
+        """Run one probe and publish the result if anything changed"""
+        state = dict(self.state)
+        state['data_files'] = SNAPSHOT_STORE.stats()['snapshots']
+        state['checked_at'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        if IS_WINDOWS:
+            result = self._probe_sap()
+            state['connections'] = result.get('connections', 0)
+            state['sessions'] = result.get('sessions', 0)
+            state['user'] = result.get('user')
+            if state['sessions'] > 0:
+                self.failures = 0
+                state['status'] = 'enabled'
+                state['message'] = f"Connected as {state['user']}"
+            else:
+                self.failures += 1
+                state['status'] = 'unavailable'
+                if not result.get('engine'):
+                    state['message'] = result.get('error') or 'SAP GUI scripting engine not available'
+                elif state['connections'] == 0:
+                    state['message'] = 'No SAP connections found. Please log into SAP.'
+                else:
+                    state['message'] = 'No SAP sessions found'
+            state['breaker_open'] = self.failures >= SAP_BREAKER_THRESHOLD
+
+        self._publish(state)
+
+    def _publish(self, state):
+        # checked_at always moves, so compare everything else
+        changed = {k: v for k, v in state.items() if k != 'checked_at'} != \
+                  {k: v for k, v in self.state.items() if k != 'checked_at'}
+        with self._cond:
+            self.state = state
+            if changed:
+                self.version += 1
+                self._cond.notify_all()
+
+    def breaker_open(self):
+        return self.state['breaker_open']
+
+    def wait_for_change(self, version, timeout):
+        """Block until the status moves past version; returns (version, state)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version, self.state
+
+SAP_HEALTH = SapHealthProber(SAP_PROBE_INTERVAL)
+
+# Priority classes for access to the SAP GUI (lower value runs first)
+PRIORITY_INTERACTIVE = 0  # Wizard starts by a technician
+PRIORITY_MANUAL = 1       # Manual /extract_data calls
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_MANUAL: 'manual',
+}
+
+# Maximum number of extractions allowed to wait for the SAP GUI
+SAP_QUEUE_LIMIT = int(os.environ.get("SAP_QUEUE_LIMIT", "8"))
+
+class SchedulerSaturated(Exception):
+    """Raised when the extraction queue has no room for another request"""
+    def __init__(self, retry_after):
+        super().__init__(f"SAP extraction queue is full, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+class ExtractionJob:
+    """A queued request to run SapExtractor for one service order"""
+    def __init__(self, service_order, priority):
+        self.service_order = service_order
+        self.priority = priority
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.cancel_event = threading.Event()
+        self.profile_label = None  # Set when a profiled request submitted the job
+        self.job_id = uuid.uuid4().hex[:12]
+        self.request_id = REQUEST_ID.get()
+        self.done = threading.Event()
+
+class InterProcessLock:
+    """
+    Exclusive lock on a file, held by one thread of one process at a time
+    Gunicorn runs several worker processes, each with its own copy of every
+    module-level object; this is what they coordinate through. Uses
+    msvcrt.locking on Windows and fcntl.flock elsewhere. The OS drops the
+    lock if its holder dies.
+    """
+    def __init__(self, path, poll=0.1):
+        self.path = path
+        self.poll = poll
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def _try_lock(self, f):
+        try:
+            if IS_WINDOWS:
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def acquire(self, cancel_event=None, timeout=None):
+        """
+        Block until the lock is held, or for at most timeout seconds
+        Returns False if the timeout ran out; raises ExtractionCancelled if
+        cancel_event is set while waiting
+        """
+        give_up = None if timeout is None else time.time() + timeout
+        if not self._thread_lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        try:
+            f = open(self.path, 'a+')
+            while not self._try_lock(f):
+                if give_up is not None and time.time() > give_up:
+                    f.close()
+                    self._thread_lock.release()
+                    return False
+                if cancel_event is None:
+                    time.sleep(self.poll)
+                elif cancel_event.wait(self.poll):
+                    f.close()
+                    raise ExtractionCancelled("Cancelled while waiting for another worker's extraction")
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        self._file = f
+        return True
+
+    def release(self):
+        f, self._file = self._file, None
+        try:
+            if IS_WINDOWS:
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        finally:
+            f.close()
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+# Held for the whole of an extraction, so the schedulers of different
+# worker processes still drive the SAP GUI one at a time
+SAP_GUI_LOCK = InterProcessLock(os.path.join(SAP_DATA_DIR, "sap_gui.lock"))
+# Held by each extractor process for its whole life, so an extractor whose
+# worker was lost (freeing SAP_GUI_LOCK) still keeps the next one waiting
+EXTRACTOR_LOCK = InterProcessLock(os.path.join(SAP_DATA_DIR, "sap_extractor.lock"))
+
+class SapScheduler:
+    """
+    Admission control in front of SapExtractor
+    There is only one desktop SAP GUI, so extractions run one at a time from
+    a bounded priority queue. Duplicate requests for an order that is already
+    queued or running share the same job instead of queueing again. Each
+    worker process has its own scheduler; they take turns at the GUI through
+    SAP_GUI_LOCK, so queue limits and coalescing are per process.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        # Manual refreshes may only use half of the queue so technicians
+        # starting the wizard always have room
+        self.class_limits = {
+            PRIORITY_INTERACTIVE: limit,
+            PRIORITY_MANUAL: max(1, limit // 2),
+        }
+        self._heap = []
+        self._seq = itertools.count()
+        self._jobs = {}  # service_order -> queued or running job
+        self._cond = threading.Condition()
+        self._worker = None
+        self._running = None
+        self._service_time = 30.0  # Moving average of extraction time in seconds
+        self._waits = collections.deque(maxlen=200)
+        self._counters = collections.Counter()
+
+    def _queued_jobs(self):
+        return [job for job in self._jobs.values() if job.started_at is None]
+
+    def retry_after(self):
+        """Estimate how many seconds until the queue has room again"""
+        with self._cond:
+            depth = len(self._queued_jobs()) + (1 if self._running else 0)
+            return max(1, int(math.ceil(self._service_time * depth)))
+
+    def submit(self, service_order, priority=PRIORITY_MANUAL):
+        """Queue an extraction, or join the one already pending for this order"""
+        # The breaker below only trips if this process is probing SAP
+        SAP_HEALTH.start()
+        if SAP_HEALTH.breaker_open():
+            with self._cond:
+                self._counters['skipped'] += 1
+            raise SapUnavailable(f"SAP is unavailable: {SAP_HEALTH.state['message']}")
+        with self._cond:
+            self._counters['submitted'] += 1
+            job = self._jobs.get(service_order)
+            # A cancelled job stays here until its extractor exits; queue a
+            # fresh one rather than hand the new caller its cancellation
+            if job is not None and not job.cancel_event.is_set():
+                self._counters['coalesced'] += 1
+                if job.started_at is None and priority < job.priority:
+                    # Promote the queued job; the old heap entry is skipped when popped
+                    job.priority = priority
+                    heapq.heappush(self._heap, (priority, next(self._seq), job))
+                return job
+
+            queued = len(self._queued_jobs())
+            if queued >= self.class_limits.get(priority, self.limit):
+                self._counters['rejected'] += 1
+                depth = queued + (1 if self._running else 0)
+                raise SchedulerSaturated(max(1, int(math.ceil(self._service_time * depth))))
+
+            job = ExtractionJob(service_order, priority)
+            job.profile_label = PROFILER.current_label()
+            self._jobs[service_order] = job
+            heapq.heappush(self._heap, (priority, next(self._seq), job))
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name="sap-scheduler", daemon=True)
+                self._worker.start()
+            self._cond.notify()
+            return job
+
+    def run(self, service_order, priority=PRIORITY_MANUAL, timeout=None):
+        """
+        Queue an extraction and block until it has finished
+        Raises ExtractionTimeout if it is not done within timeout seconds;
+        the extraction itself carries on so its snapshot is there next time
+        """
+        job = self.submit(service_order, priority)
+        if not job.done.wait(timeout):
+            with self._cond:
+                self._counters['timed_out'] += 1
+            raise ExtractionTimeout(
+                f"Extraction of {service_order} did not finish within {timeout:.0f}s")
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def cancel(self, service_order):
+        """
+        Cancel the queued or running extraction for a service order
+        Returns False if there was nothing to cancel
+        """
+        with self._cond:
+            job = self._jobs.get(service_order)
+            if job is None:
+                return False
+            self._counters['cancelled'] += 1
+            job.cancel_event.set()
+            if job.started_at is not None:
+                # The extractor notices the event and kills its process
+                return True
+            job.cancelled = True
+            job.error = ExtractionCancelled(f"Extraction of {service_order} was cancelled")
+            del self._jobs[service_order]
+        job.done.set()
+        return True
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                while self._heap:
+                    priority, _, job = heapq.heappop(self._heap)
+                    # Skip entries left behind by a promotion
+                    if job.started_at is None and not job.cancelled and priority == job.priority:
+                        job.started_at = time.time()
+                        self._running = job
+                        return job
+                self._cond.wait()
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            wait = job.started_at - job.enqueued_at
+            job_token = JOB_ID.set(job.job_id)
+            request_token = REQUEST_ID.set(job.request_id)
+            scheduler_log.info("Starting extraction of %s", job.service_order,
+                               extra={'fields': {'service_order': job.service_order,
+                                                 'priority': PRIORITY_NAMES[job.priority],
+                                                 'wait': round(wait, 3)}})
+            if job.profile_label:
+                PROFILER.begin(f"{job.profile_label};[scheduler]")
+            try:
+                SAP_GUI_LOCK.acquire(job.cancel_event)
+                try:
+                    job.result = SapExtractor.extract_data(job.service_order, job.cancel_event,
+                                                           job.profile_label)
+                finally:
+                    SAP_GUI_LOCK.release()
+            except Exception as e:
+                scheduler_log.exception("Error in scheduled extraction for %s: %s", job.service_order, e)
+                job.error = e
+            finally:
+                if job.profile_label:
+                    PROFILER.end()
+                JOB_ID.reset(job_token)
+                REQUEST_ID.reset(request_token)
+            job.finished_at = time.time()
+
+            with self._cond:
+                duration = job.finished_at - job.started_at
+                self._service_time = 0.8 * self._service_time + 0.2 * duration
+                self._waits.append((PRIORITY_NAMES[job.priority], wait))
+                self._counters['completed'] += 1
+                self._running = None
+                if self._jobs.get(job.service_order) is job:
+                    del self._jobs[job.service_order]
+            job.done.set()
+
+    def metrics(self):
+        """Snapshot of queue depth and wait times for /scheduler_metrics"""
+        with self._cond:
+            queued = self._queued_jobs()
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for job in queued:
+                depth[PRIORITY_NAMES[job.priority]] += 1
+
+            waits = {}
+            for name in PRIORITY_NAMES.values():
+                samples = sorted(w for n, w in self._waits if n == name)
+                if samples:
+                    waits[name] = {
+                        'count': len(samples),
+                        'avg': round(sum(samples) / len(samples), 3),
+                        'p95': round(samples[int(round(0.95 * (len(samples) - 1)))], 3),
+                        'max': round(samples[-1], 3),
+                    }
+
+            return {
+                'queue_limit': self.limit,
+                'queue_depth': len(queued),
+                'queue_depth_by_class': depth,
+                'running': self._running.service_order if self._running else None,
+                'avg_service_time': round(self._service_time, 3),
+                'wait_time': waits,
+                'submitted': self._counters['submitted'],
+                'coalesced': self._counters['coalesced'],
+                'rejected': self._counters['rejected'],
+                'completed': self._counters['completed'],
+                'cancelled': self._counters['cancelled'],
+                'skipped_sap_down': self._counters['skipped'],
+                'timed_out': self._counters['timed_out'],
+                'watchdog_kills': EXTRACTION_WATCHDOG.killed,
+            }
+
+# Single scheduler shared by every request path in this worker
+SAP_SCHEDULER = SapScheduler(SAP_QUEUE_LIMIT)
+
+def saturated_response(error, as_json=False):
+    """Build a 429 response for a request rejected by the SAP scheduler"""
+    headers = {'Retry-After': str(error.retry_after)}
+    message = f'SAP is busy with other requests. Please try again in {error.retry_after} seconds.'
+    if as_json:
+        return jsonify({
+            'status': 'busy',
+            'message': message,
+            'retry_after': error.retry_after
+        }), 429, headers
+    return render_template('error.html',
+                           title='SAP Busy',
+                           message=message), 429, headers
+
+class SnapshotStore:
+    """
+    Content-addressed storage for extracted snapshots
+    Each distinct payload is written once under objects/, named by its
+    SHA-256. Every extraction appends an "order timestamp hash" line to a
+    shared journal, so re-extracting an unchanged order only costs one line;
+    appends are serialised across processes by a lock file next to it.
+    The journal is tailed into memory, so finding the newest snapshot for an
+    order is a dict lookup plus one stat() to notice other workers' writes.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.objects_dir = os.path.join(data_dir, "objects")
+        self.incoming_dir = os.path.join(data_dir, "incoming")
+        self.journal_path = os.path.join(data_dir, "snapshots.journal")
+        # Writers in other processes take turns appending to the journal
+        self._journal_lock = InterProcessLock(f"{self.journal_path}.lock")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        self._refs = {}      # service_order -> sorted [(timestamp, hash)]
+        self._entries = []   # (service_order, timestamp, hash) in journal order
+        self._hashes = set()
+        self._offset = 0
+        self._migrated = False
+        self._lock = threading.RLock()
+        self.bytes_written = 0
+        self.bytes_deduplicated = 0
+
+    @staticmethod
+    def snapshot_id(service_order, timestamp):
+        return f"so_{service_order}_{timestamp}"
+
+    @staticmethod
+    def parse_snapshot_id(snapshot_id):
+        """Split so_SERVICEORDER_TIMESTAMP[.json] into (service_order, timestamp)"""
+        if snapshot_id.endswith(".json"):
+            snapshot_id = snapshot_id[:-5]
+        if not snapshot_id.startswith("so_"):
+            return None
+        service_order, _, timestamp = snapshot_id[3:].rpartition('_')
+        if not service_order or not timestamp.isdigit():
+            return None
+        return service_order, int(timestamp)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.json")
+
+    def put(self, service_order, timestamp, data):
+        """Store a snapshot and return its id; identical payloads share one object"""
+        payload = json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self._object_path(digest)
         
-        # Store the data in session
-        session['order_data'] = order_data
-        return redirect(url_for('automation_wizard', step=1))
+        with self._lock:
+            if os.path.exists(path):
+                self.bytes_deduplicated += len(payload)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+                self.bytes_written += len(payload)
+            
+            # O_APPEND alone does not keep two processes' lines apart on
+            # every platform (Windows in particular), so append under the lock
+            with self._journal_lock, open(self.journal_path, 'ab') as f:
+                f.write(f"{service_order} {timestamp} {digest}\n".encode('utf-8'))
+        self.catch_up()
+        return self.snapshot_id(service_order, timestamp)
+
+    def ingest(self, path, service_order, timestamp):
+        """Move an extractor output file into the store"""
+        with open(path, 'r') as f:
+            data = json.load(f)
+        snapshot_id = self.put(service_order, timestamp, data)
+        os.remove(path)
+        return snapshot_id
+
+    def migrate_legacy(self):
+        """Move so_<order>_<ts>.json files from before the store into it"""
+        self._migrated = True
+        migrated = 0
+        for filename in os.listdir(self.data_dir):
+            parsed = self.parse_snapshot_id(filename)
+            if parsed is None or not filename.endswith(".json"):
+                continue
+            try:
+                self.ingest(os.path.join(self.data_dir, filename), *parsed)
+                migrated += 1
+            except FileNotFoundError:
+                pass  # Another worker got there first
+            except Exception as e:
+                snapshot_log.error("Error migrating %s: %s", filename, e)
+        if migrated:
+            snapshot_log.info("Migrated %d snapshot file(s) into the snapshot store", migrated)
+
+    def catch_up(self):
+        """Read journal lines appended since the last call (by any process)"""
+        if not self._migrated:
+            self.migrate_legacy()
+        try:
+            size = os.stat(self.journal_path).st_size
+        except FileNotFoundError:
+            return
+        if size == self._offset:
+            return
         
+        with self._lock:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(self._offset)
+                chunk = f.read(size - self._offset)
+            # Leave a partially written last line for next time
+            end = chunk.rfind(b'\n') + 1
+            self._offset += end
+            for line in chunk[:end].decode('utf-8').splitlines():
+                try:
+                    service_order, timestamp, digest = line.rsplit(' ', 2)
+                    timestamp = int(timestamp)
+                except ValueError:
+                    continue
+                refs = self._refs.setdefault(service_order, [])
+                i = bisect.bisect_left(refs, (timestamp,))
+                if i < len(refs) and refs[i][0] == timestamp:
+                    # Same order extracted twice in one second; the later write wins
+                    refs[i] = (timestamp, digest)
+                else:
+                    refs.insert(i, (timestamp, digest))
+                self._entries.append((service_order, timestamp, digest))
+                self._hashes.add(digest)
+
+    def load_object(self, digest):
+        with open(self._object_path(digest), 'r') as f:
+            return json.load(f)
+
+    def history(self, service_order):
+        """All snapshots of an order as (snapshot_id, timestamp, hash), oldest first"""
+        self.catch_up()
+        with self._lock:
+            return [(self.snapshot_id(service_order, ts), ts, digest)
+                    for ts, digest in self._refs.get(service_order, [])]
+
+    def get(self, snapshot_id):
+        """Load a snapshot by id; None if there is no such snapshot"""
+        parsed = self.parse_snapshot_id(snapshot_id)
+        if parsed is None:
+            return None
+        service_order, timestamp = parsed
+        self.catch_up()
+        with self._lock:
+            refs = self._refs.get(service_order, [])
+            i = bisect.bisect_left(refs, (timestamp,))
+            if i == len(refs) or refs[i][0] != timestamp:
+                return None
+            digest = refs[i][1]
+        return self.load_object(digest)
+
+    def newest(self, service_order):
+        """The newest snapshot of an order as (snapshot_id, timestamp, data)"""
+        self.catch_up()
+        with self._lock:
+            refs = self._refs.get(service_order)
+            if not refs:
+                return None, None, None
+            timestamp, digest = refs[-1]
+        return self.snapshot_id(service_order, timestamp), timestamp, self.load_object(digest)
+
+    def entries_since(self, position):
+        """Journal entries after position, and the position to resume from"""
+        self.catch_up()
+        with self._lock:
+            return self._entries[position:], len(self._entries)
+
+    def stats(self):
+        self.catch_up()
+        with self._lock:
+            return {
+                'snapshots': len(self._entries),
+                'objects': len(self._hashes),
+                'orders': len(self._refs),
+                'dedup_factor': round(len(self._entries) / len(self._hashes), 2) if self._hashes else None,
+                'bytes_written': self.bytes_written,
+                'bytes_deduplicated': self.bytes_deduplicated,
+            }
+
+SNAPSHOT_STORE = SnapshotStore(SAP_DATA_DIR)
+
+def diff_snapshots(old, new):
+    """Field-level differences between two snapshots of the same order"""
+    changes = []
+    for field in sorted(set(old) | set(new)):
+        before, after = old.get(field), new.get(field)
+        if before == after:
+            continue
+        change = {'field': field, 'from': before, 'to': after}
+        if isinstance(before, list) and isinstance(after, list):
+            change['added'] = [item for item in after if item not in before]
+            change['removed'] = [item for item in before if item not in after]
+        changes.append(change)
+    return changes
+
+# Snapshot fields that can be searched, in the order results list them
+SEARCH_FIELDS = ('service_order', 'part_number', 'serial_number', 'customer',
+                 'notifications', 'auth_documents')
+
+class SnapshotIndex:
+    """
+    In-memory inverted index over the snapshots in the snapshot store
+    Every value of a searchable field is a term; each term maps to the set of
+    snapshot ids containing it. Terms are also kept sorted per field so
+    prefix lookups are a binary search plus a scan of the matching range.
+    The first build runs in the background; until it is done, requests are
+    served from whatever has been indexed so far.
+    """
+    def __init__(self, store):
+        self.store = store
+        self._postings = {field: {} for field in SEARCH_FIELDS}
+        self._terms = {field: [] for field in SEARCH_FIELDS}
+        # snapshot id -> (service_order, timestamp, part_number, serial_number, customer)
+        self._docs = {}
+        self._doc_terms = {}  # snapshot id -> [(field, term)], for removal
+        self._position = 0  # How far into the store journal we have indexed
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()  # One refresh at a time
+        self._built = threading.Event()
+
+    @property
+    def building(self):
+        """True until the first full build has finished"""
+        return not self._built.is_set()
+
+    def build_in_background(self):
+        """Index the existing snapshots on a thread, so no request waits for it"""
+        def build():
+            try:
+                self.refresh()
+            except Exception as e:
+                snapshot_log.exception("Error building the snapshot index: %s", e)
+            finally:
+                self._built.set()
+        threading.Thread(target=build, name="snapshot-index", daemon=True).start()
+
+    @staticmethod
+    def normalize(value):
+        return str(value).strip().upper()
+
+    def add(self, snapshot_id, data, _bulk=False):
+        """Index one snapshot"""
+        parsed = SnapshotStore.parse_snapshot_id(snapshot_id)
+        if parsed is None:
+            return False
+
+        with self._lock:
+            if snapshot_id in self._docs:
+                self.remove(snapshot_id)
+            service_order, timestamp = parsed
+            self._docs[snapshot_id] = (service_order, timestamp, data.get('part_number'),
+                                       data.get('serial_number'), data.get('customer'))
+            doc_terms = []
+            for field in SEARCH_FIELDS:
+                values = data.get(field)
+                if field == 'service_order' and not values:
+                    values = service_order
+                if not isinstance(values, (list, tuple)):
+                    values = [values]
+                for value in values:
+                    if value in (None, ''):
+                        continue
+                    term = sys.intern(self.normalize(value))
+                    postings = self._postings[field]
+                    if term not in postings:
+                        postings[term] = set()
+                        if not _bulk:
+                            bisect.insort(self._terms[field], term)
+                    postings[term].add(snapshot_id)
+                    doc_terms.append((field, term))
+            self._doc_terms[snapshot_id] = doc_terms
+        return True
+
+    def remove(self, snapshot_id):
+        """Drop a snapshot from the index"""
+        with self._lock:
+            self._docs.pop(snapshot_id, None)
+            for field, term in self._doc_terms.pop(snapshot_id, []):
+                postings = self._postings[field].get(term)
+                if postings is None:
+                    continue
+                postings.discard(snapshot_id)
+                if not postings:
+                    del self._postings[field][term]
+                    terms = self._terms[field]
+                    i = bisect.bisect_left(terms, term)
+                    if i < len(terms) and terms[i] == term:
+                        del terms[i]
+
+    def refresh(self, wait=True):
+        """
+        Index snapshots added to the store since the last refresh (by any process)
+        With wait=False, returns at once if another refresh is under way
+        """
+        if not self._refresh_lock.acquire(blocking=wait):
+            return
+        try:
+            entries, position = self.store.entries_since(self._position)
+            if not entries:
+                return
+            bulk = len(entries) > 100
+            # Load objects outside the index lock, so searches carry on meanwhile;
+            # deduplicated snapshots share an object, so load each one once
+            objects = {}
+            for service_order, timestamp, digest in entries:
+                try:
+                    if digest not in objects:
+                        objects[digest] = self.store.load_object(digest)
+                except Exception as e:
+                    snapshot_log.error("Error indexing snapshot object %s: %s", digest, e)
+            with self._lock:
+                for service_order, timestamp, digest in entries:
+                    if digest in objects:
+                        self.add(SnapshotStore.snapshot_id(service_order, timestamp),
+                                 objects[digest], _bulk=bulk)
+                if bulk:
+                    for field in SEARCH_FIELDS:
+                        self._terms[field] = sorted(self._postings[field])
+                self._position = position
+            if bulk:
+                snapshot_log.info("Indexed %d snapshot(s), %d total", len(entries), len(self._docs))
+        finally:
+            self._refresh_lock.release()
+
+    def _lookup(self, field, term, prefix):
+        postings = self._postings[field]
+        if not prefix:
+            return postings.get(term, set())
+        terms = self._terms[field]
+        matches = set()
+        i = bisect.bisect_left(terms, term)
+        while i < len(terms) and terms[i].startswith(term):
+            matches |= postings[terms[i]]
+            i += 1
+        return matches
+
+    def search(self, query, fields=SEARCH_FIELDS, prefix=True, page=1, per_page=20):
+        """
+        Find orders with a snapshot field value equal to (or starting with) query
+        Each order is listed once, as its newest matching snapshot, with the
+        number of its snapshots that matched. Returns (total orders, results)
+        with results for the requested page, newest first
+        """
+        self.refresh(wait=False)
+        term = self.normalize(query)
+        if not term:
+            return 0, []
+        with self._lock:
+            field_matches = [(field, self._lookup(field, term, prefix)) for field in fields]
+            matches = set().union(*(found for _, found in field_matches))
+            docs = self._docs
+            newest_per_order = {}
+            snapshot_counts = collections.Counter()
+            for f in matches:
+                service_order = docs[f][0]
+                snapshot_counts[service_order] += 1
+                best = newest_per_order.get(service_order)
+                if best is None or docs[f][1] > docs[best][1]:
+                    newest_per_order[service_order] = f
+            # Only the entries up to the requested page need ordering
+            start = (page - 1) * per_page
+            newest = heapq.nlargest(start + per_page, newest_per_order.values(), key=lambda f: docs[f][1])
+            results = [dict(self._summary(f),
+                            matched=[field for field, found in field_matches if f in found],
+                            snapshots=snapshot_counts[docs[f][0]])
+                       for f in newest[start:]]
+        return len(newest_per_order), results
+
+    def recent(self, count):
+        """The newest snapshots across all orders"""
+        self.refresh(wait=False)
+        with self._lock:
+            newest = heapq.nlargest(count, self._docs, key=lambda f: self._docs[f][1])
+            return [self._summary(f) for f in newest]
+
+    def _summary(self, snapshot_id):
+        service_order, timestamp, part_number, serial_number, customer = self._docs[snapshot_id]
+        return {
+            'snapshot_id': snapshot_id,
+            'service_order': service_order,
+            'modified': datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+            'part_number': part_number or 'Unknown',
+            'serial_number': serial_number or 'Unknown',
+            'customer': customer,
+        }
+
+SNAPSHOT_INDEX = SnapshotIndex(SNAPSHOT_STORE)
+SNAPSHOT_INDEX.build_in_background()
+
+def find_newest_snapshot(service_order):
+    """
+    Find the newest extracted snapshot for a service order
+    Returns (snapshot_id, data), or (None, None) if there is no readable snapshot
+    """
+    try:
+        snapshot_id, _, data = SNAPSHOT_STORE.newest(service_order)
+        return snapshot_id, data
     except Exception as e:
-        error_details = traceback.format_exc()
-        print(f"Error getting service order data: {e}")
-        print(error_details)
-        return redirect(url_for('index', error=f'Error getting service order data: {str(e)}'))
+        snapshot_log.error("Error reading existing snapshot: %s", e)
+        return None, None
 
-@app.route('/automation_wizard')
-def automation_wizard():
-    """Render the automation wizard interface"""
-    service_order = session.get('service_order', '')
-    step = int(request.args.get('step', 1))
+def order_from_snapshot(snapshot_id, data):
+    """A ServiceOrder for a stored snapshot, recording where and when it came from"""
+    order = ServiceOrder.from_dict(data)
+    order.snapshot_id = snapshot_id
+    order.snapshot_time = datetime.datetime.fromtimestamp(
+        SnapshotStore.parse_snapshot_id(snapshot_id)[1]).strftime('%Y-%m-%d %H:%M:%S')
+    return order
+
+def stale_snapshot(service_order, reason):
+    """
+    Return the newest snapshot for a service order marked as stale,
+    for use when a fresh extraction missed its deadline
+    """
+    snapshot_id, data = find_newest_snapshot(service_order)
+    if data is None:
+        return None
+    order = order_from_snapshot(snapshot_id, data)
+    order.stale_reason = reason
+    return order
+
+def get_service_order_data(service_order, priority=PRIORITY_INTERACTIVE):
+    """
+    Get service order data for the specified service order as a ServiceOrder
+    Uses the newest existing snapshot, else extracts from SAP on Windows and
+    simulates the order elsewhere. On Windows a failed extraction raises
+    (ExtractionTimeout, ExtractionCancelled, SapUnavailable or
+    ExtractionFailed) instead of passing simulated data off as the order's;
+    SchedulerSaturated if an extraction is needed but SAP is too busy
+    """
+    # Check cache first
+    if service_order in SAP_DATA_CACHE:
+        return SAP_DATA_CACHE[service_order]
     
-    if not service_order:
-        return redirect(url_for('index', error='Service order number is missing'))
+    # If we have existing files, use the newest one
+    snapshot_id, data = find_newest_snapshot(service_order)
+    if data is not None:
+        log.debug("Using existing data from %s", snapshot_id)
+        order = order_from_snapshot(snapshot_id, data)
+        
+        # Cache the data
+        SAP_DATA_CACHE[service_order] = order
+        return order
     
-    # Get the service order data
-    order_data = session.get('order_data')
-    if not order_data:
+    # If we're on Windows, try to extract from SAP
+    if IS_WINDOWS:
+        # There is no earlier snapshot to fall back on, so a failure here
+        # goes back to the technician to retry rather than to a simulation
         try:
-            order_data = get_service_order_data(service_order)
-            session['order_data'] = order_data
-        except Exception as e:
-            return redirect(url_for('index', error=f'Error getting service order data: {str(e)}'))
+            snapshot_id = SAP_SCHEDULER.run(service_order, priority, timeout=SAP_REQUEST_DEADLINE)
+        except (ExtractionTimeout, ExtractionCancelled, SapUnavailable) as e:
+            log.warning("Extraction did not complete: %s", e)
+            raise
+        data = SNAPSHOT_STORE.get(snapshot_id) if snapshot_id else None
+        if data is None:
+            raise ExtractionFailed(f"SAP returned no data for service order {service_order}; "
+                                   "check SAP and try again")
+        order = order_from_snapshot(snapshot_id, data)
+        log.debug("Using freshly extracted data from %s", snapshot_id)
+        
+        # Cache the data
+        SAP_DATA_CACHE[service_order] = order
+        return order
     
-    # Logic for different steps of the wizard with real SAP data
-    steps = {
+    return simulate_service_order_data(service_order)
+
+def simulate_service_order_data(service_order):
+    """Simulate service order data"""
+    log.debug("Simulating data for service order: %s", service_order)
+    
+    # Create a realistic looking but fake data set
+    order = ServiceOrder.placeholder(
+        service_order,
+        equipment=f"EQ-{service_order}",
+        found_issues=service_order.endswith('1'),  # Some orders will have issues for testing
+    )
+    
+    # Cache this data
+    SAP_DATA_CACHE[service_order] = order
+    return order
+
+class WizardProgressStore:
+    """
+    Durable wizard progress, one JSON file per service order, so a run can
+    be picked up again on any terminal or worker
+    A run is pinned to the snapshot its order data came from. Resuming loads
+    that snapshot instead of fetching the order again, and each answer
+    records the snapshot it was given against. Simulated orders have no
+    snapshot, so their runs are unpinned and look the order up again.
+    Runs in progress live directly under root; completed and terminated
+    ones are moved to root/finished, so listing live runs for the index page
+    does not read every run ever recorded. Counters for resumes, pinned
+    loads, redone steps and duplicate extractions are kept per order and
+    summed by metrics().
+    """
+    COUNTERS = ('resumes', 'pinned_loads', 'redone_steps', 'duplicate_extractions')
+    # Ids of offline answers already applied, kept so a replayed sync is not applied twice
+    SYNCED_IDS_KEPT = 200
+
+    def __init__(self, root):
+        self.root = root
+        self.finished_dir = os.path.join(root, "finished")
+        os.makedirs(self.finished_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # Records from before finished runs were moved out of root
+        for record in list(self.records(finished=False)):
+            if record['status'] != 'in_progress':
+                try:
+                    os.replace(self._path(record['service_order']),
+                               self._path(record['service_order'], finished=True))
+                except FileNotFoundError:
+                    pass  # Another worker moved it first
+
+    def _path(self, service_order, finished=False):
+        # Order numbers come from a form field; keep them to a safe file name
+        safe = "".join(c for c in service_order if c.isalnum() or c in "-_")
+        return os.path.join(self.finished_dir if finished else self.root, f"{safe}.json")
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.error("Error reading wizard progress from %s: %s", path, e)
+            return None
+
+    def load(self, service_order):
+        """The progress record of a service order; None if it has none"""
+        records = [record for record in (self._read(self._path(service_order)),
+                                         self._read(self._path(service_order, finished=True)))
+                   if record is not None]
+        # Both exist only if a move was interrupted; the later write wins
+        return max(records, key=lambda record: record['updated']) if records else None
+
+    def _save(self, record):
+        record['updated'] = time.time()
+        finished = record['status'] != 'in_progress'
+        path = self._path(record['service_order'], finished)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+        try:
+            os.remove(self._path(record['service_order'], not finished))
+        except FileNotFoundError:
+            pass
+
+    def active(self, service_order):
+        """The in-progress run of a service order, if there is one"""
+        record = self.load(service_order)
+        if record is not None and record['status'] == 'in_progress':
+            return record
+        return None
+
+    def start(self, service_order, order):
+        """Start a new run pinned to the order's snapshot, abandoning any run in progress"""
+        with self._lock:
+            previous = self.load(service_order) or {}
+            superseded = []
+            if previous.get('status') == 'in_progress':
+                # Steps answered in the abandoned run count as redone if answered again
+                superseded = sorted(set(previous.get('superseded', [])) |
+                                    {int(step) for step in previous.get('answers', {})})
+            record = {
+                'service_order': service_order,
+                'run_id': uuid.uuid4().hex,
+                'status': 'in_progress',
+                'started': time.time(),
+                'snapshot_id': order.snapshot_id,
+                'next_step': 1,
+                'answers': {},
+                'superseded': superseded,
+                'synced': previous.get('synced', {}),
+            }
+            for counter in self.COUNTERS:
+                record[counter] = previous.get(counter, 0)
+            self._save(record)
+        log.info("Started wizard run", extra={'fields': {
+            'service_order': service_order, 'run_id': record['run_id'], 'snapshot_id': order.snapshot_id}})
+        return record
+
+    def pinned_order(self, record):
+        """The ServiceOrder a run is pinned to, without fetching it again; None if unpinned or gone"""
+        if not record['snapshot_id']:
+            return None
+        data = SNAPSHOT_STORE.get(record['snapshot_id'])
+        if data is None:
+            log.warning("Pinned snapshot %s of %s is missing", record['snapshot_id'], record['service_order'])
+            return None
+        order = order_from_snapshot(record['snapshot_id'], data)
+        self.count(record['service_order'], 'pinned_loads')
+        return order
+
+    def count(self, service_order, counter, amount=1):
+        """Add to one of the COUNTERS of a service order's record"""
+        with self._lock:
+            record = self.load(service_order)
+            if record is None:
+                return
+            record[counter] = record.get(counter, 0) + amount
+            self._save(record)
+
+    def record_answer(self, service_order, order, step, response, user_input, result, source='online',
+                      answer_id=None):
+        """
+        Checkpoint an answer and what it led to, starting a run if none is in
+        progress; answer_id marks an offline answer as applied
+        """
+        if self.active(service_order) is None:
+            self.start(service_order, order)
+        with self._lock:
+            record = self.load(service_order)
+            key = str(step)
+            previous = record['answers'].get(key)
+            # Answering again after a retry outcome is the step asking for it,
+            # not the technician redoing it
+            if step in record['superseded']:
+                record['redone_steps'] += 1
+                record['superseded'].remove(step)
+            elif previous is not None and previous['outcome'] != 'retry':
+                record['redone_steps'] += 1
+            record['answers'][key] = {
+                'response': response,
+                'manual_input': user_input,
+                'outcome': result['outcome'],
+                'snapshot_id': order.snapshot_id,
+                'source': source,
+                'answered_at': time.time(),
+            }
+            if result['outcome'] == 'next':
+                record['next_step'] = max(record['next_step'], result['next_step'])
+                if record['next_step'] > WIZARD_TOTAL_STEPS:
+                    record['status'] = 'completed'
+            elif result['outcome'] == 'terminate':
+                record['status'] = 'terminated'
+            if answer_id:
+                synced = record.setdefault('synced', {})
+                synced[answer_id] = {'outcome': result['outcome'], 'next_step': result.get('next_step')}
+                for stale_id in list(synced)[:-self.SYNCED_IDS_KEPT]:
+                    del synced[stale_id]
+            self._save(record)
+        return record
+
+    def complete(self, service_order):
+        with self._lock:
+            record = self.load(service_order)
+            if record is not None and record['status'] == 'in_progress':
+                record['status'] = 'completed'
+                self._save(record)
+
+    def records(self, finished=True):
+        """Every progress record; with finished=False, only runs in progress"""
+        directories = (self.root, self.finished_dir) if finished else (self.root,)
+        for directory in directories:
+            for filename in os.listdir(directory):
+                if filename.endswith('.json'):
+                    record = self._read(os.path.join(directory, filename))
+                    if record is not None:
+                        yield record
+
+    def in_progress(self, limit=5):
+        """The most recently updated runs still in progress, for the index page"""
+        runs = [record for record in self.records(finished=False) if record['status'] == 'in_progress']
+        runs.sort(key=lambda record: record['updated'], reverse=True)
+        return [{
+            'service_order': record['service_order'],
+            'next_step': record['next_step'],
+            'answered': len(record['answers']),
+            'snapshot_id': record['snapshot_id'],
+            'updated': datetime.datetime.fromtimestamp(record['updated']).strftime('%Y-%m-%d %H:%M:%S'),
+        } for record in runs[:limit]]
+
+    def metrics(self):
+        """Run counts and counter totals over every service order, for /progress_metrics"""
+        totals = {counter: 0 for counter in self.COUNTERS}
+        statuses = {'in_progress': 0, 'completed': 0, 'terminated': 0}
+        answered = 0
+        for record in self.records():
+            statuses[record['status']] = statuses.get(record['status'], 0) + 1
+            answered += len(record['answers'])
+            for counter in self.COUNTERS:
+                totals[counter] += record.get(counter, 0)
+        return dict(totals, runs=statuses, answered_steps=answered)
+
+WIZARD_PROGRESS = WizardProgressStore(os.path.join(SAP_DATA_DIR, "progress"))
+
+# Wizard steps that ask for a value typed off the unit, and the field it must match
+MANUAL_ENTRY_STEPS = {3: 'part_number', 4: 'serial_number'}
+# Steps where answering "No" is the good outcome
+NEGATIVE_IS_GOOD_STEPS = {16}
+WIZARD_TOTAL_STEPS = 20
+
+# Why the process stops when a step is answered "No"
+STEP_ERROR_MESSAGES = {
+    1: 'Part Number does not match. Process terminated.',
+    2: 'Serial Number does not match. Process terminated.',
+    5: 'Operator comments have issues. Process terminated.',
+    6: 'Unit mod status has issues. Process terminated.',
+    7: 'Z8 notifications have issues. Process terminated.',
+    8: 'Hardware verification failed. Process terminated.',
+    9: 'Connectors verification failed. Process terminated.',
+    10: 'FOD check failed. Process terminated.',
+    11: 'Customer requirements not met. Process terminated.',
+    12: 'Authorization documents not properly processed. Process terminated.',
+    13: 'Authorization documents do not match service report. Process terminated.',
+    14: 'Service report is incomplete. Process terminated.',
+    15: 'Test sheet does not match unit. Process terminated.',
+    17: 'Test sheet not properly signed. Process terminated.',
+    18: 'Inspection indicators incorrect. Process terminated.',
+    19: 'Repairman line not signed. Process terminated.',
+    20: 'WSUPD comments not updated. Process terminated.',
+}
+
+def build_wizard_steps(order_data):
+    """The wizard's steps for a ServiceOrder, keyed by step number"""
+    return {
         1: {'title': 'Part Number Verification', 
             'question': 'Does the Part Number match the ID plate on the unit and the outgoing Part Number in SAP?',
-            'pn': order_data.get('part_number', 'Unknown')
+            'pn': order_data.part_number or 'Unknown'
            },
         2: {'title': 'Serial Number Verification', 
             'question': 'Does the Serial Number match the ID plate on the unit and the outgoing Serial Number in SAP?',
-            'sn': order_data.get('serial_number', 'Unknown')
+            'sn': order_data.serial_number or 'Unknown'
            },
         3: {'title': 'Manual Entry Verification', 
             'question': 'Please enter the Part Number from the Unit being inspected to verify:',
             'input_type': 'manual_entry',
-            'part_number': order_data.get('part_number', 'Unknown')
+            'part_number': order_data.part_number or 'Unknown'
            },
         4: {'title': 'Manual Entry Verification', 
             'question': 'Please enter the Serial Number from the Unit being inspected to verify:',
             'input_type': 'manual_entry',
-            'serial_number': order_data.get('serial_number', 'Unknown')
+            'serial_number': order_data.serial_number or 'Unknown'
            },
         5: {'title': 'Operator Comments', 
-            'question': f'Have you verified the operator comments to ensure there are no mismatches or discrepancies compared to actual repairs?\n\nOperator Comments: "{order_data.get("op_comments", "None")}"'
+            'question': f'Have you verified the operator comments to ensure there are no mismatches or discrepancies compared to actual repairs?\n\nOperator Comments: "{order_data.op_comments}"'
            },
         6: {'title': 'Unit Mod Status', 
-            'question': f'Have you verified the unit mod status and confirmed it matches the actual unit configuration?\n\nMod Status: {order_data.get("mod_status", "Unknown")}'
+            'question': f'Have you verified the unit mod status and confirmed it matches the actual unit configuration?\n\nMod Status: {order_data.mod_status or "Unknown"}'
            },
         7: {'title': 'Z8 Notifications', 
-            'question': f'Have you verified that all Z8 notifications have been properly processed?\n\nNotifications: {", ".join(order_data.get("notifications", ["None"]))}'
+            'question': f'Have you verified that all Z8 notifications have been properly processed?\n\nNotifications: {", ".join(order_data.notifications)}'
            },
         8: {'title': 'Hardware Verification', 
             'question': 'Have you verified that all hardware has been properly inspected and is in good condition?'
@@ -715,10 +2639,10 @@ def automation_wizard():
              'question': 'Have you verified that the unit is free of FOD (Foreign Object Debris)?'
             },
         11: {'title': 'Customer Requirements', 
-             'question': f'Have you verified that all customer requirements have been addressed and completed?\n\nCustomer: {order_data.get("customer", "Unknown")}'
+             'question': f'Have you verified that all customer requirements have been addressed and completed?\n\nCustomer: {order_data.customer or "Unknown"}'
             },
         12: {'title': 'Authorization Documents', 
-             'question': f'Have you verified that all authorization documents have been properly processed?\n\nDocuments: {", ".join(order_data.get("auth_documents", ["None"]))}'
+             'question': f'Have you verified that all authorization documents have been properly processed?\n\nDocuments: {", ".join(order_data.auth_documents)}'
             },
         13: {'title': 'Service Report Match', 
              'question': 'Do the authorization documents match the service report?'
@@ -727,7 +2651,7 @@ def automation_wizard():
              'question': 'Is the service report complete with all required information filled in?'
             },
         15: {'title': 'Test Sheet Match', 
-             'question': f'Does the test sheet match the unit being inspected?\n\nTest Sheets: {", ".join(order_data.get("test_sheets", ["None"]))}'
+             'question': f'Does the test sheet match the unit being inspected?\n\nTest Sheets: {", ".join(order_data.test_sheets)}'
             },
         16: {'title': 'Test Sheet Failures', 
              'question': 'Does the test sheet show any failures or issues that need to be addressed?',
@@ -746,9 +2670,392 @@ def automation_wizard():
              'question': 'Do you want to update the WSUPD comments with completion information?'
             },
     }
+
+def evaluate_step(order_data, current_step, response, user_input=None, retry=False):
+    """
+    Decide what answering a wizard step leads to
+    Used by process_step and /sync_answers, so answers given offline get
+    exactly the result they would have had online. Returns a dict whose
+    'outcome' is 'next' (with next_step), 'retry' (with step_data for the
+    retry page) or 'terminate' (with title and message).
+    """
+    # Special handling for manual entry steps
+    if current_step in MANUAL_ENTRY_STEPS:
+        field = MANUAL_ENTRY_STEPS[current_step]
+        label = field.replace('_', ' ').title()
+        expected = getattr(order_data, field) or ''
+        user_input = user_input or ''
+        log.debug("Manual entry check",
+                  extra={'fields': {'step': current_step, 'user_input': user_input, 'expected': expected}})
+        
+        if user_input == expected:
+            return {'outcome': 'next', 'next_step': current_step + 1}
+        if not retry:
+            # If first attempt, give another chance
+            return {'outcome': 'retry',
+                    'step_data': {
+                        'title': f'{label} Verification - Retry',
+                        'question': f'The {label} does not match. Please try again:',
+                        'input_type': field,
+                        'error': f'Expected: {expected}, You entered: {user_input}'
+                    }}
+        # Second failure, exit the process
+        return {'outcome': 'terminate',
+                'title': f'{label} Mismatch',
+                'message': f'The {label} entered ({user_input}) does not match the expected value from SAP ({expected}). The process has been terminated.'}
+    
+    response = (response or 'no').lower()
+    if current_step in NEGATIVE_IS_GOOD_STEPS:
+        # "Does test sheet show failures?" - "No" is good
+        if response == 'yes':
+            return {'outcome': 'terminate',
+                    'title': 'Test Sheet Failures',
+                    'message': 'The test sheet shows failures that need to be addressed. Process terminated.'}
+        return {'outcome': 'next', 'next_step': current_step + 1}
+    
+    if response == 'no':
+        # For other questions, "No" means we should stop with an error
+        return {'outcome': 'terminate',
+                'title': 'Process Terminated',
+                'message': STEP_ERROR_MESSAGES.get(current_step, 'An issue was detected. Process terminated.')}
+    
+    return {'outcome': 'next', 'next_step': current_step + 1}
+
+def run_order_data(run):
+    """
+    The order data of a run in progress: its pinned snapshot, or for an
+    unpinned (simulated) run the order looked up again; None if the pinned
+    snapshot is gone
+    """
+    if run['snapshot_id']:
+        return WIZARD_PROGRESS.pinned_order(run)
+    return get_service_order_data(run['service_order'])
+
+def session_order_data(service_order):
+    """
+    The order data kept in the session; if it is missing, the snapshot the
+    run in progress is pinned to, and only failing that a fresh fetch
+    """
+    order_data = ServiceOrder.from_session(session.get('order_data'))
+    if not order_data:
+        run = WIZARD_PROGRESS.active(service_order)
+        if run is not None:
+            order_data = run_order_data(run)
+        if not order_data:
+            order_data = get_service_order_data(service_order)
+        session['order_data'] = order_data.to_session()
+    return order_data
+
+# Shared secret for the /debug endpoints and the X-Profile header;
+# the debug surface is switched off entirely when it is not set
+SSOE_DEBUG_TOKEN = os.environ.get("SSOE_DEBUG_TOKEN")
+
+class RequestProfiler:
+    """
+    Sampling profiler that can be switched on per route at runtime
+    A sampler thread periodically reads the stacks of the threads currently
+    serving profiled requests and counts them as folded stacks
+    (route;outer;...;inner). While nothing is being profiled the only cost
+    per request is one attribute check in the before_request hook.
+    """
+    def __init__(self, interval=0.005):
+        self.enabled = False
+        self.interval = interval
+        self.routes = {}  # endpoint -> fraction of its requests to profile
+        self.samples = 0
+        self._active = {}  # thread ident -> label
+        self._stacks = collections.Counter()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def configure(self, routes, interval=None):
+        """Profile the given {endpoint: sample rate} routes from now on"""
+        with self._lock:
+            self.routes = {endpoint: min(1.0, max(0.0, float(rate))) for endpoint, rate in routes.items()}
+            if interval:
+                self.interval = max(0.001, float(interval))
+            self.enabled = bool(self.routes)
+
+    def disable(self):
+        with self._lock:
+            self.routes = {}
+            self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def should_profile(self, endpoint):
+        rate = self.routes.get(endpoint, 0)
+        return rate > 0 and random.random() < rate
+
+    def begin(self, label):
+        """Start sampling the calling thread under label"""
+        with self._lock:
+            self._active[threading.get_ident()] = label
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._sample, name="ssoe-profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def end(self):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def current_label(self):
+        """The label the calling thread is profiled under, if any"""
+        return self._active.get(threading.get_ident())
+
+    def _sample(self):
+        while True:
+            if not self._active:
+                self._wake.clear()
+                # begin() may have run between the check and the clear, and
+                # its wake-up would be lost; look again before sleeping
+                if not self._active:
+                    self._wake.wait()
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, label in list(self._active.items()):
+                    frame = frames.get(ident)
+                    names = []
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    if names:
+                        names.append(label)
+                        self._stacks[";".join(reversed(names))] += 1
+                        self.samples += 1
+            time.sleep(self.interval)
+
+    def merge_folded_file(self, path, prefix):
+        """Add folded stacks written by another process under prefix"""
+        try:
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            for line in lines:
+                stack, _, count = line.rpartition(' ')
+                if stack and count.isdigit():
+                    self._stacks[f"{prefix};{stack}"] += int(count)
+                    self.samples += int(count)
+
+    def folded(self, route=None):
+        """Folded stacks ("frame;frame;frame count"), optionally for one route"""
+        with self._lock:
+            items = list(self._stacks.items())
+        return [(stack, count) for stack, count in items
+                if route is None or stack.split(';', 1)[0] == route]
+
+    def flamegraph(self, route=None):
+        """Samples as a nested {name, value, children} tree for flame graph viewers"""
+        root = {'name': route or 'all', 'value': 0, 'children': {}}
+        for stack, count in self.folded(route):
+            root['value'] += count
+            node = root
+            for name in stack.split(';'):
+                child = node['children'].get(name)
+                if child is None:
+                    child = node['children'][name] = {'name': name, 'value': 0, 'children': {}}
+                child['value'] += count
+                node = child
+
+        def finish(node):
+            node['children'] = [finish(child) for child in node['children'].values()]
+            return node
+        return finish(root)
+
+PROFILER = RequestProfiler()
+
+def debug_token_matches(value):
+    """Compare a header value with SSOE_DEBUG_TOKEN in constant time"""
+    if not SSOE_DEBUG_TOKEN or value is None:
+        return False
+    return hmac.compare_digest(value.encode('utf-8'), SSOE_DEBUG_TOKEN.encode('utf-8'))
+
+def debug_authorized():
+    """Check the X-Debug-Token header against SSOE_DEBUG_TOKEN"""
+    return debug_token_matches(request.headers.get('X-Debug-Token'))
+
+@app.before_request
+def assign_request_id():
+    """Tag this request's log records with an id (the caller's X-Request-ID if sent)"""
+    g.request_id_token = REQUEST_ID.set(request.headers.get('X-Request-ID') or uuid.uuid4().hex[:12])
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers['X-Request-ID'] = REQUEST_ID.get()
+    return response
+
+@app.before_request
+def start_profiling():
+    """Sample this request if its route is being profiled or it asks to be"""
+    if not PROFILER.enabled and 'X-Profile' not in request.headers:
+        return
+    forced = debug_token_matches(request.headers.get('X-Profile'))
+    if forced or (PROFILER.enabled and PROFILER.should_profile(request.endpoint)):
+        PROFILER.begin(request.endpoint or request.path)
+        g.profiled = True
+
+@app.teardown_request
+def stop_profiling(error=None):
+    if g.get('profiled'):
+        PROFILER.end()
+
+@app.teardown_request
+def clear_request_id(error=None):
+    token = g.get('request_id_token')
+    if token is not None:
+        REQUEST_ID.reset(token)
+
+# Global context processor to add date to all templates
+@app.context_processor
+def inject_now():
+    # Check if we're on Windows (can potentially extract SAP data)
+    if IS_WINDOWS:
+        sap_mode = "SAP Data Extraction Enabled"
+    else:
+        sap_mode = "Simulation Mode (Not Windows)"
+    
+    return {
+        'now': datetime.datetime.now().strftime('%Y-%m-%d'),
+        'sap_mode': sap_mode
+    }
+
+@app.route('/')
+def index():
+    """Render the main web interface"""
+    # Check if we're on Windows (can potentially extract SAP data)
+    if IS_WINDOWS:
+        sap_status = "SAP Data Extraction Enabled"
+    else:
+        sap_status = "Simulation Mode (Not Windows)"
+    
+    # Most recent extractions, straight from the snapshot index
+    data_files = SNAPSHOT_INDEX.recent(5)
+    
+    return render_template('index.html', 
+                          sap_status=sap_status,
+                          is_windows=IS_WINDOWS,
+                          data_files=data_files,
+                          in_progress=WIZARD_PROGRESS.in_progress(5))
+
+@app.route('/sap_status')
+def sap_status():
+    """Report the cached SAP status from the background prober"""
+    SAP_HEALTH.start()
+    return jsonify(SAP_HEALTH.state)
+
+@app.route('/sap_status/stream')
+def sap_status_stream():
+    """
+    Push SAP status changes to the page as Server-Sent Events
+    Over SAP_STATUS_STREAM_LIMIT open streams, answers 204, which tells
+    EventSource not to reconnect; the page then asks /sap_status once.
+    """
+    SAP_HEALTH.start()
+    if not SAP_STATUS_STREAMS.acquire(blocking=False):
+        return Response(status=204)
+    
+    def events():
+        closes_at = time.time() + SAP_STATUS_STREAM_SECONDS
+        version, state = SAP_HEALTH.version, SAP_HEALTH.state
+        # EventSource reconnects a second after the stream ends
+        yield "retry: 1000\n"
+        yield f"data: {json.dumps(state)}\n\n"
+        while True:
+            remaining = closes_at - time.time()
+            if remaining <= 0:
+                return
+            new_version, state = SAP_HEALTH.wait_for_change(version, timeout=min(15, remaining))
+            if new_version == version:
+                # Keep idle connections open through proxies
+                yield ": keepalive\n\n"
+                continue
+            version = new_version
+            yield f"data: {json.dumps(state)}\n\n"
+    
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(SAP_STATUS_STREAMS.release)
+    return response
+
+@app.route('/run_automation', methods=['POST'])
+def run_automation():
+    """Handle the form submission to start automation"""
+    service_order = request.form.get('service_order', '')
+    if not service_order:
+        return redirect(url_for('index', error='Please enter a service order number'))
+
+    # Add a small delay to ensure the spinner is visible
+    time.sleep(1)
+    
+    # Store the service order number in session for the wizard
+    session['service_order'] = service_order
+    
+    # Set SAP mode based on platform
+    session['sap_mode'] = 'extraction' if IS_WINDOWS else 'simulation'
+    
+    try:
+        # Pick up a run left in progress, on this terminal or another one,
+        # against the data it was started with
+        run = WIZARD_PROGRESS.active(service_order)
+        if run is not None and not request.form.get('restart'):
+            order_data = run_order_data(run)
+            if order_data:
+                WIZARD_PROGRESS.count(service_order, 'resumes')
+                session['order_data'] = order_data.to_session()
+                log.info("Resuming wizard run", extra={'fields': {
+                    'service_order': service_order, 'run_id': run['run_id'], 'step': run['next_step']}})
+                return redirect(url_for('automation_wizard', step=run['next_step']))
+        
+        # Try to get the service order data (this will extract from SAP if possible)
+        order_data = get_service_order_data(service_order)
+        
+        if not order_data:
+            # Service order not found
+            return redirect(url_for('index', error=f'Service order {service_order} not found'))
+        
+        # Store the data in session
+        session['order_data'] = order_data.to_session()
+        WIZARD_PROGRESS.start(service_order, order_data)
+        return redirect(url_for('automation_wizard', step=1))
+        
+    except SchedulerSaturated as e:
+        return saturated_response(e)
+    except Exception as e:
+        log.exception("Error getting service order data: %s", e)
+        return redirect(url_for('index', error=f'Error getting service order data: {str(e)}'))
+
+@app.route('/automation_wizard')
+def automation_wizard():
+    """Render the automation wizard interface"""
+    service_order = session.get('service_order', '')
+    step = int(request.args.get('step', 1))
+    
+    if not service_order:
+        return redirect(url_for('index', error='Service order number is missing'))
+    
+    # Get the service order data
+    try:
+        order_data = session_order_data(service_order)
+    except SchedulerSaturated as e:
+        return saturated_response(e)
+    except Exception as e:
+        return redirect(url_for('index', error=f'Error getting service order data: {str(e)}'))
+    
+    steps = build_wizard_steps(order_data)
     
     # If we've gone past all steps, show completion
     if step > len(steps):
+        WIZARD_PROGRESS.complete(service_order)
         return render_template('completion.html', service_order=service_order)
     
     # Get SAP connection mode
@@ -759,6 +3066,7 @@ def automation_wizard():
                           step_data=steps[step],
                           current_step=step,
                           total_steps=len(steps),
+                          order_data=order_data,
                           sap_mode=sap_mode)
 
 @app.route('/process_step', methods=['POST'])
@@ -769,115 +3077,212 @@ def process_step():
     response = request.form.get('response', 'no')
     
     # Get the service order data
-    order_data = session.get('order_data')
-    if not order_data:
-        try:
-            order_data = get_service_order_data(service_order)
-            session['order_data'] = order_data
-        except Exception as e:
-            return render_template('error.html',
-                                 title='Data Error',
-                                 message=f'Error getting service order data: {str(e)}')
+    try:
+        order_data = session_order_data(service_order)
+    except SchedulerSaturated as e:
+        return saturated_response(e)
+    except Exception as e:
+        return render_template('error.html',
+                             title='Data Error',
+                             message=f'Error getting service order data: {str(e)}')
     
-    # Special handling for manual entry steps
-    if current_step == 3:  # Part number verification
-        user_input = request.form.get('manual_input')
-        print("User input:", user_input)
-        expected = order_data.get('part_number')
-        print("Expected:", expected)
-        
-        if user_input != expected:
-            # If first attempt, give another chance
-            if 'retry' not in request.form:
-                return render_template('wizard.html',
-                                      service_order=service_order,
-                                      step_data={
-                                          'title': 'Part Number Verification - Retry',
-                                          'question': 'The Part Number does not match. Please try again:',
-                                          'input_type': 'part_number',
-                                          'error': f'Expected: {expected}, You entered: {user_input}'
-                                      },
-                                      current_step=current_step,
-                                      total_steps=20,
-                                      retry=True,
-                                      sap_mode=session.get('sap_mode', 'simulation'))
-            else:
-                # Second failure, exit the process
-                return render_template('error.html',
-                                     title='Part Number Mismatch',
-                                     message=f'The Part Number entered ({user_input}) does not match the expected value from SAP ({expected}). The process has been terminated.')
-        else:
-            next_step = current_step + 1
-            return redirect(url_for('automation_wizard', step=next_step))
-        
-    if current_step == 4:  # Serial number verification
-        user_input = request.form.get('manual_input', '')
-        expected = order_data.get('serial_number', '')
-                
-        if user_input != expected:
-            # If first attempt, give another chance
-            if 'retry' not in request.form:
-                return render_template('wizard.html',
-                                      service_order=service_order,
-                                      step_data={
-                                          'title': 'Serial Number Verification - Retry',
-                                          'question': 'The Serial Number does not match. Please try again:',
-                                          'input_type': 'serial_number',
-                                          'error': f'Expected: {expected}, You entered: {user_input}'
-                                      },
-                                      current_step=current_step,
-                                      total_steps=20,
-                                      retry=True,
-                                      sap_mode=session.get('sap_mode', 'simulation'))
-            else:
-                # Second failure, exit the process
-                return render_template('error.html',
-                                     title='Serial Number Mismatch',
-                                     message=f'The Serial Number entered ({user_input}) does not match the expected value from SAP ({expected}). The process has been terminated.')
-        else:
-            next_step = current_step + 1
-            return redirect(url_for('automation_wizard', step=next_step))
-        
-    # For yes/no questions
-    if response.lower() == 'no':
-        # Step 16 is special: "Does test sheet show failures?" - "No" is good
-        if current_step == 16:
-            next_step = current_step + 1
-        else:
-            # For other questions, "No" means we should stop with an error
-            error_messages = {
-                1: 'Part Number does not match. Process terminated.',
-                2: 'Serial Number does not match. Process terminated.',
-                5: 'Operator comments have issues. Process terminated.',
-                6: 'Unit mod status has issues. Process terminated.',
-                7: 'Z8 notifications have issues. Process terminated.',
-                8: 'Hardware verification failed. Process terminated.',
-                9: 'Connectors verification failed. Process terminated.',
-                10: 'FOD check failed. Process terminated.',
-                11: 'Customer requirements not met. Process terminated.',
-                12: 'Authorization documents not properly processed. Process terminated.',
-                13: 'Authorization documents do not match service report. Process terminated.',
-                14: 'Service report is incomplete. Process terminated.',
-                15: 'Test sheet does not match unit. Process terminated.',
-                17: 'Test sheet not properly signed. Process terminated.',
-                18: 'Inspection indicators incorrect. Process terminated.',
-                19: 'Repairman line not signed. Process terminated.',
-                20: 'WSUPD comments not updated. Process terminated.',
-            }
-            
-            return render_template('error.html',
-                                 title='Process Terminated',
-                                 message=error_messages.get(current_step, 'An issue was detected. Process terminated.'))
+    user_input = request.form.get('manual_input')
+    result = evaluate_step(order_data, current_step, response, user_input, 'retry' in request.form)
+    WIZARD_PROGRESS.record_answer(service_order, order_data, current_step, response, user_input, result)
     
-    # For step 16, "Yes" means there are failures, which is bad
-    if current_step == 16 and response.lower() == 'yes':
+    if result['outcome'] == 'retry':
+        # First mismatch on a manual entry step: give another chance
+        return render_template('wizard.html',
+                              service_order=service_order,
+                              step_data=result['step_data'],
+                              current_step=current_step,
+                              total_steps=WIZARD_TOTAL_STEPS,
+                              retry=True,
+                              order_data=order_data,
+                              sap_mode=session.get('sap_mode', 'simulation'))
+    if result['outcome'] == 'terminate':
         return render_template('error.html',
-                             title='Test Sheet Failures',
-                             message='The test sheet shows failures that need to be addressed. Process terminated.')
+                             title=result['title'],
+                             message=result['message'])
     
     # Move to next step
-    next_step = current_step + 1
-    return redirect(url_for('automation_wizard', step=next_step))
+    return redirect(url_for('automation_wizard', step=result['next_step']))
+
+# Stands in for what the operator types when step pages are rendered ahead of time
+OFFLINE_INPUT_TOKEN = '__SSOE_INPUT__'
+OFFLINE_TITLE_TOKEN = '__SSOE_TITLE__'
+OFFLINE_MESSAGE_TOKEN = '__SSOE_MESSAGE__'
+
+@app.route('/sw.js')
+def service_worker():
+    """Serve the service worker from the site root so it controls every page"""
+    response = send_from_directory(os.path.join(app.static_folder, 'js'), 'sw.js',
+                                   mimetype='application/javascript')
+    # Browsers check for a new worker on each navigation; never let a stale one stick
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/wizard_bundle')
+def wizard_bundle():
+    """
+    Everything the wizard needs to run without the server: the order data,
+    each step pre-rendered, and the outcome of every possible answer
+    """
+    service_order = session.get('service_order', '')
+    if not service_order:
+        return jsonify({
+            'status': 'error',
+            'message': 'Service order number is missing'
+        }), 400
+    
+    try:
+        order_data = session_order_data(service_order)
+    except SchedulerSaturated as e:
+        return saturated_response(e, as_json=True)
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'Error getting service order data: {str(e)}'
+        }), 500
+    
+    sap_mode = session.get('sap_mode', 'simulation')
+    steps = build_wizard_steps(order_data)
+    
+    def render_step(step, step_data, retry=False):
+        return render_template('_wizard_step.html',
+                               service_order=service_order,
+                               step_data=step_data,
+                               current_step=step,
+                               total_steps=len(steps),
+                               retry=retry,
+                               order_data=order_data,
+                               sap_mode=sap_mode)
+    
+    bundle_steps = {}
+    for step, step_data in steps.items():
+        entry = {'html': render_step(step, step_data)}
+        if step in MANUAL_ENTRY_STEPS:
+            expected = getattr(order_data, MANUAL_ENTRY_STEPS[step]) or ''
+            retry = evaluate_step(order_data, step, None, OFFLINE_INPUT_TOKEN)
+            entry['manual'] = {
+                'expected': expected,
+                'match': evaluate_step(order_data, step, None, expected),
+                'retry': dict(retry, html=render_step(step, retry['step_data'], retry=True)),
+                'mismatch': evaluate_step(order_data, step, None, OFFLINE_INPUT_TOKEN, retry=True),
+            }
+        else:
+            entry['outcomes'] = {response: evaluate_step(order_data, step, response)
+                                 for response in ('yes', 'no')}
+        bundle_steps[step] = entry
+    
+    return jsonify({
+        'status': 'success',
+        'service_order': service_order,
+        'snapshot_id': order_data.snapshot_id,
+        'total_steps': len(steps),
+        'order': order_data.summary(),
+        'steps': bundle_steps,
+        'tokens': {'input': OFFLINE_INPUT_TOKEN,
+                   'title': OFFLINE_TITLE_TOKEN,
+                   'message': OFFLINE_MESSAGE_TOKEN},
+        'pages': {
+            'completion': render_template('completion.html', service_order=service_order),
+            'error': render_template('error.html', title=OFFLINE_TITLE_TOKEN, message=OFFLINE_MESSAGE_TOKEN),
+        },
+        'generated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    })
+
+@app.route('/sync_answers', methods=['POST'])
+def sync_answers():
+    """
+    Replay wizard answers queued by the offline client
+    Each answer is checked with evaluate_step, so it gets the same outcome
+    process_step would have given. An answer may go back to an earlier step
+    but not skip ahead of where the run has reached, and a retry must follow
+    a mismatch on that step; once one is out of sequence, it and everything
+    after it are rejected. Answers carry an id, and one already applied (a
+    sync whose response was lost) is reported as a duplicate, not applied
+    again.
+    """
+    payload = request.get_json(silent=True) or {}
+    service_order = session.get('service_order', '')
+    if not service_order or payload.get('service_order') != service_order:
+        return jsonify({
+            'status': 'error',
+            'message': 'Answers are for a different service order than this session'
+        }), 409
+    
+    try:
+        order_data = session_order_data(service_order)
+    except SchedulerSaturated as e:
+        return saturated_response(e, as_json=True)
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'Error getting service order data: {str(e)}'
+        }), 500
+    
+    # Pick up where the durable run left off, not where this batch starts
+    record = WIZARD_PROGRESS.load(service_order) or {}
+    synced = record.get('synced', {})
+    if record.get('status') == 'in_progress':
+        expected_step = record['next_step']
+        outcomes = {int(key): answer['outcome'] for key, answer in record['answers'].items()}
+    else:
+        expected_step = 1
+        outcomes = {}
+    
+    results = []
+    broken = None
+    for answer in payload.get('answers', []):
+        try:
+            step = int(answer.get('step'))
+        except (TypeError, ValueError):
+            step = None
+        retry = bool(answer.get('retry'))
+        answer_id = answer.get('id')
+        
+        if answer_id and answer_id in synced:
+            results.append(dict(synced[answer_id], step=step, status='duplicate'))
+            continue
+        if broken is None:
+            if step is None or not 1 <= step <= WIZARD_TOTAL_STEPS:
+                broken = f'Step {answer.get("step")} does not exist'
+            elif step > expected_step:
+                broken = f'Step {step} answered before step {expected_step}'
+            elif retry and outcomes.get(step) != 'retry':
+                broken = f'Step {step} retried without a mismatch'
+        if broken is not None:
+            results.append({'step': step, 'status': 'rejected', 'reason': broken})
+            continue
+        
+        result = evaluate_step(order_data, step, answer.get('response'), answer.get('manual_input'), retry)
+        WIZARD_PROGRESS.record_answer(service_order, order_data, step, answer.get('response'),
+                                      answer.get('manual_input'), result, source='offline',
+                                      answer_id=answer_id)
+        result.update(step=step, status='accepted')
+        if answer.get('outcome') is not None:
+            result['matches_client'] = answer['outcome'] == result['outcome']
+        results.append(result)
+        
+        outcomes[step] = result['outcome']
+        if result['outcome'] == 'next':
+            expected_step = max(expected_step, result['next_step'])
+        elif result['outcome'] == 'terminate':
+            broken = 'The process was terminated by an earlier answer'
+    
+    counts = collections.Counter(result['status'] for result in results)
+    log.info("Synced offline answers",
+             extra={'fields': {'service_order': service_order, 'answers': len(results),
+                               'accepted': counts['accepted'], 'duplicates': counts['duplicate']}})
+    return jsonify({
+        'status': 'success',
+        'service_order': service_order,
+        'accepted': counts['accepted'],
+        'duplicates': counts['duplicate'],
+        'rejected': counts['rejected'],
+        'results': results
+    })
 
 @app.route('/extract_data/<service_order>', methods=['GET'])
 def extract_data(service_order):
@@ -888,22 +3293,44 @@ def extract_data(service_order):
             'message': 'SAP data extraction is only available on Windows'
         })
     
-    data_file = SapExtractor.extract_data(service_order)
-    if data_file:
+    try:
+        snapshot_id = SAP_SCHEDULER.run(service_order, PRIORITY_MANUAL, timeout=SAP_REQUEST_DEADLINE)
+    except SchedulerSaturated as e:
+        return saturated_response(e, as_json=True)
+    except SapUnavailable as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 503
+    except ExtractionCancelled as e:
+        return jsonify({
+            'status': 'cancelled',
+            'message': str(e)
+        })
+    except ExtractionTimeout as e:
+        order = stale_snapshot(service_order, str(e))
+        if order is None:
+            return jsonify({
+                'status': 'error',
+                'message': f'{e} and no earlier data exists'
+            }), 504
+        return jsonify({
+            'status': 'stale',
+            'message': f'{e}; returning the newest existing data',
+            'stale': True,
+            'snapshot_time': order.snapshot_time,
+            'data': order.summary()
+        })
+    
+    if snapshot_id:
         try:
-            with open(data_file, 'r') as f:
-                data = json.load(f)
+            order = ServiceOrder.from_dict(SNAPSHOT_STORE.get(snapshot_id))
                 
             return jsonify({
                 'status': 'success',
                 'message': f'Data extracted successfully',
-                'file': data_file,
-                'data': {
-                    'service_order': data.get('service_order'),
-                    'part_number': data.get('part_number'),
-                    'serial_number': data.get('serial_number'),
-                    'customer': data.get('customer')
-                }
+                'snapshot_id': snapshot_id,
+                'data': order.summary()
             })
         except Exception as e:
             return jsonify({
@@ -916,6 +3343,193 @@ def extract_data(service_order):
             'message': 'Failed to extract data'
         })
 
+@app.route('/cancel_extraction/<service_order>', methods=['POST'])
+def cancel_extraction(service_order):
+    """Cancel a queued or running extraction for a service order"""
+    if SAP_SCHEDULER.cancel(service_order):
+        return jsonify({
+            'status': 'success',
+            'message': f'Extraction of {service_order} cancelled'
+        })
+    return jsonify({
+        'status': 'error',
+        'message': f'No extraction in progress for {service_order}'
+    }), 404
+
+@app.route('/snapshots/<service_order>')
+def snapshot_history(service_order):
+    """List the stored snapshots of a service order, newest first"""
+    history = SNAPSHOT_STORE.history(service_order)
+    return jsonify({
+        'status': 'success',
+        'service_order': service_order,
+        'snapshots': [{
+            'snapshot_id': snapshot_id,
+            'time': datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+            'hash': digest
+        } for snapshot_id, timestamp, digest in reversed(history)]
+    })
+
+@app.route('/snapshots/<service_order>/diff')
+def snapshot_diff(service_order):
+    """
+    Show field-level differences between two snapshots of a service order
+    Defaults to the two newest snapshots; ?from=<id>&to=<id> picks others
+    """
+    history = SNAPSHOT_STORE.history(service_order)
+    by_id = {snapshot_id: digest for snapshot_id, _, digest in history}
+    from_id = request.args.get('from') or (history[-2][0] if len(history) >= 2 else None)
+    to_id = request.args.get('to') or (history[-1][0] if history else None)
+    
+    if from_id is None or to_id is None:
+        return jsonify({
+            'status': 'error',
+            'message': f'Service order {service_order} needs at least two snapshots to compare'
+        }), 404
+    missing = [i for i in (from_id, to_id) if i not in by_id]
+    if missing:
+        return jsonify({
+            'status': 'error',
+            'message': f'No snapshot {", ".join(missing)} for service order {service_order}'
+        }), 404
+    
+    # Snapshots with the same hash are identical without loading either
+    changes = []
+    if by_id[from_id] != by_id[to_id]:
+        changes = diff_snapshots(SNAPSHOT_STORE.load_object(by_id[from_id]),
+                                 SNAPSHOT_STORE.load_object(by_id[to_id]))
+    return jsonify({
+        'status': 'success',
+        'service_order': service_order,
+        'from': from_id,
+        'to': to_id,
+        'identical': not changes,
+        'changes': changes
+    })
+
+@app.route('/snapshot_stats')
+def snapshot_stats():
+    """Report how much the content-addressed store is deduplicating"""
+    return jsonify(SNAPSHOT_STORE.stats())
+
+@app.route('/progress_metrics')
+def progress_metrics():
+    """Report wizard resumes, redone steps and extractions the progress store avoided or saw repeated"""
+    return jsonify(WIZARD_PROGRESS.metrics())
+
+@app.route('/extraction_plan')
+def extraction_plan():
+    """Show the compiled SAP extraction plan and what it costs in navigations and tab switches"""
+    return jsonify(EXTRACTION_PLAN)
+
+@app.route('/speculation_stats')
+def speculation_stats():
+    """Report which order prefixes run IW32 alongside ZIWBN and the latency saved"""
+    return jsonify(SAP_SPECULATION.stats())
+
+@app.route('/search')
+def search():
+    """Search extracted snapshots by order, part, serial, customer or document number"""
+    query = request.args.get('q', '').strip()
+    field = request.args.get('field')
+    mode = request.args.get('mode', 'prefix')
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(100, max(1, int(request.args.get('per_page', 20))))
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'page and per_page must be numbers'
+        }), 400
+    
+    if not query:
+        return jsonify({
+            'status': 'error',
+            'message': 'Please enter a search term'
+        }), 400
+    if field and field not in SEARCH_FIELDS:
+        return jsonify({
+            'status': 'error',
+            'message': f'Unknown field {field}; expected one of {", ".join(SEARCH_FIELDS)}'
+        }), 400
+    if mode not in ('prefix', 'exact'):
+        return jsonify({
+            'status': 'error',
+            'message': 'mode must be prefix or exact'
+        }), 400
+    
+    started = time.perf_counter()
+    total, results = SNAPSHOT_INDEX.search(query,
+                                           fields=(field,) if field else SEARCH_FIELDS,
+                                           prefix=(mode == 'prefix'),
+                                           page=page,
+                                           per_page=per_page)
+    return jsonify({
+        'status': 'success',
+        'query': query,
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': (total + per_page - 1) // per_page,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+        # Results may be incomplete while the index is still being built
+        'indexing': SNAPSHOT_INDEX.building,
+        'results': results
+    })
+
+@app.route('/debug/profiler', methods=['GET', 'POST', 'DELETE'])
+def debug_profiler():
+    """
+    Control the request profiler
+    POST {"routes": {"index": 0.1}, "interval": 0.005} starts sampling 10% of
+    index() requests; DELETE switches profiling off and clears the samples
+    """
+    if not debug_authorized():
+        return jsonify({'status': 'error', 'message': 'Not found'}), 404
+    
+    if request.method == 'POST':
+        config = request.get_json(silent=True) or {}
+        routes = config.get('routes', {})
+        unknown = [endpoint for endpoint in routes if endpoint not in app.view_functions]
+        if unknown:
+            return jsonify({
+                'status': 'error',
+                'message': f'Unknown route(s): {", ".join(unknown)}'
+            }), 400
+        PROFILER.configure(routes, config.get('interval'))
+    elif request.method == 'DELETE':
+        PROFILER.disable()
+        PROFILER.reset()
+    
+    return jsonify({
+        'status': 'success',
+        'enabled': PROFILER.enabled,
+        'routes': PROFILER.routes,
+        'interval': PROFILER.interval,
+        'samples': PROFILER.samples
+    })
+
+@app.route('/debug/flamegraph')
+def debug_flamegraph():
+    """
+    Serve aggregated profiles as flame graph data
+    ?route=<endpoint> limits it to one route; ?format=folded returns the
+    folded-stack text used by flamegraph.pl and speedscope
+    """
+    if not debug_authorized():
+        return jsonify({'status': 'error', 'message': 'Not found'}), 404
+    
+    route = request.args.get('route')
+    if request.args.get('format') == 'folded':
+        body = "\n".join(f"{stack} {count}" for stack, count in PROFILER.folded(route))
+        return Response(body + "\n", mimetype='text/plain')
+    return jsonify(PROFILER.flamegraph(route))
+
+@app.route('/scheduler_metrics')
+def scheduler_metrics():
+    """Report SAP extraction queue depth and wait times"""
+    return jsonify(SAP_SCHEDULER.metrics())
+
 if __name__ == '__main__':
     print(f"Starting Combined SAP Web Application")
     print(f"Platform: {platform.system()}")
@@ -924,19 +3538,16 @@ if __name__ == '__main__':
 
     sap_status = "SAP Data Extraction Enabled"
     
-    # Check for existing data files
-    if os.path.exists(SAP_DATA_DIR):
-        data_files = [f for f in os.listdir(SAP_DATA_DIR) if f.endswith('.json')]
-        print(f"Found {len(data_files)} existing data file(s)")
-        
-        # Show details for up to 3 most recent files
-        if data_files:
-            print("Most recent data files:")
-            files_with_times = [(f, os.path.getmtime(os.path.join(SAP_DATA_DIR, f))) for f in data_files]
-            files_with_times.sort(key=lambda x: x[1], reverse=True)
-            
-            for filename, mtime in files_with_times[:3]:
-                modified = datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
-                print(f"  {filename} (modified {modified})")
+    # Report the existing snapshots
+    stats = SNAPSHOT_STORE.stats()
+    print(f"Found {stats['snapshots']} existing snapshot(s) of {stats['orders']} order(s), "
+          f"stored as {stats['objects']} unique object(s)")
+    
+    # Show details for up to 3 most recent snapshots
+    recent = SNAPSHOT_INDEX.recent(3)
+    if recent:
+        print("Most recent snapshots:")
+        for snapshot in recent:
+            print(f"  {snapshot['snapshot_id']} (extracted {snapshot['modified']})")
     
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
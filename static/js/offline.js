@@ -0,0 +1,282 @@
+// Offline support for the SAP Service Order Automation wizard
+// Step pages come pre-rendered from /wizard_bundle and are swapped in place,
+// so moving between steps needs no network. Answers are queued locally and
+// replayed to /sync_answers, which checks them exactly like /process_step
+// and skips any it has already applied.
+
+if ('serviceWorker' in navigator) {
+    window.addEventListener('load', function() {
+        navigator.serviceWorker.register('/sw.js').catch(function(error) {
+            console.warn('Service worker registration failed:', error);
+        });
+    });
+}
+
+const SsoeOffline = (function() {
+    let bundle = null;
+    let serviceOrder = null;
+    let syncing = false;
+
+    function bundleKey() { return 'ssoe-bundle:' + serviceOrder; }
+    function answersKey() { return 'ssoe-answers:' + serviceOrder; }
+
+    function readJson(key, fallback) {
+        try {
+            const value = localStorage.getItem(key);
+            return value ? JSON.parse(value) : fallback;
+        } catch (e) {
+            return fallback;
+        }
+    }
+
+    function writeJson(key, value) {
+        try {
+            localStorage.setItem(key, JSON.stringify(value));
+        } catch (e) {
+            console.warn('Could not save to local storage:', e);
+        }
+    }
+
+    function escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text == null ? '' : String(text);
+        return div.innerHTML;
+    }
+
+    function fill(html, replacements) {
+        Object.keys(replacements).forEach(function(token) {
+            html = html.split(token).join(replacements[token]);
+        });
+        return html;
+    }
+
+    // Load the bundle for this order: fresh from the server, else the local copy
+    function loadBundle() {
+        return fetch('/wizard_bundle', { credentials: 'same-origin' })
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                if (data.status !== 'success' || data.service_order !== serviceOrder) {
+                    throw new Error(data.message || 'Bundle is for another service order');
+                }
+                writeJson(bundleKey(), data);
+                return data;
+            })
+            .catch(function(error) {
+                console.warn('Using cached wizard bundle:', error);
+                return readJson(bundleKey(), null);
+            });
+    }
+
+    function pendingAnswers() { return readJson(answersKey(), []); }
+
+    // Lets the server spot an answer it already applied when a sync is replayed
+    function answerId() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    }
+
+    function queueAnswer(answer) {
+        const answers = pendingAnswers();
+        answers.push(answer);
+        writeJson(answersKey(), answers);
+        updateSyncBadge();
+    }
+
+    function updateSyncBadge() {
+        const count = pendingAnswers().length;
+        let badge = document.getElementById('ssoeSyncBadge');
+        if (!badge) {
+            const header = document.querySelector('header .badge');
+            if (!header) {
+                return;
+            }
+            badge = document.createElement('span');
+            badge.id = 'ssoeSyncBadge';
+            badge.className = 'badge ms-2';
+            header.parentNode.appendChild(badge);
+        }
+        if (!navigator.onLine) {
+            badge.className = 'badge ms-2 bg-warning text-dark';
+            badge.innerHTML = '<i class="fas fa-wifi"></i> Offline' + (count ? ' - ' + count + ' answers queued' : '');
+        } else if (count) {
+            badge.className = 'badge ms-2 bg-info text-dark';
+            badge.innerHTML = '<i class="fas fa-sync-alt fa-spin"></i> Syncing ' + count + ' answers';
+        } else {
+            badge.className = 'badge ms-2 d-none';
+        }
+    }
+
+    // Show a page taken from a full rendered template
+    function showPage(html) {
+        const page = new DOMParser().parseFromString(html, 'text/html');
+        const main = page.querySelector('main');
+        if (main) {
+            document.querySelector('main').innerHTML = main.innerHTML;
+        }
+        window.scrollTo(0, 0);
+    }
+
+    function showStep(step, html) {
+        const container = document.getElementById('wizardStep');
+        if (!container) {
+            return;
+        }
+        container.innerHTML = html;
+        const manualInput = document.getElementById('manual_input');
+        if (manualInput) {
+            manualInput.focus();
+        }
+        window.scrollTo(0, 0);
+    }
+
+    function goToStep(step, replace) {
+        const url = '/automation_wizard?step=' + step;
+        if (step > bundle.total_steps) {
+            showPage(bundle.pages.completion);
+        } else {
+            showStep(step, bundle.steps[step].html);
+        }
+        history[replace ? 'replaceState' : 'pushState']({ ssoeStep: step }, '', url);
+    }
+
+    // Work out what an answer leads to using the outcomes the server precomputed
+    function evaluate(step, response, manualInput, retry) {
+        const entry = bundle.steps[step];
+        if (entry.manual) {
+            if ((manualInput || '') === entry.manual.expected) {
+                return entry.manual.match;
+            }
+            return retry ? entry.manual.mismatch : entry.manual.retry;
+        }
+        return entry.outcomes[response === 'yes' ? 'yes' : 'no'];
+    }
+
+    function applyOutcome(result, step, manualInput) {
+        const input = escapeHtml(manualInput || '');
+        const tokens = {};
+        tokens[bundle.tokens.input] = input;
+        if (result.outcome === 'next') {
+            goToStep(result.next_step);
+        } else if (result.outcome === 'retry') {
+            showStep(step, fill(result.html, tokens));
+        } else {
+            tokens[bundle.tokens.title] = escapeHtml(result.title);
+            tokens[bundle.tokens.message] = fill(escapeHtml(result.message), tokens);
+            showPage(fill(bundle.pages.error, tokens));
+        }
+    }
+
+    function onSubmit(event) {
+        const form = event.target;
+        if (!bundle || form.getAttribute('action') !== '/process_step') {
+            return;
+        }
+        const step = parseInt(form.querySelector('input[name="current_step"]').value, 10);
+        if (!bundle.steps[step]) {
+            return;
+        }
+        event.preventDefault();
+
+        const submitter = event.submitter;
+        const response = submitter && submitter.name === 'response' ? submitter.value : 'no';
+        const manualField = form.querySelector('input[name="manual_input"]');
+        const manualInput = manualField ? manualField.value : null;
+        const retry = !!form.querySelector('input[name="retry"]');
+
+        const result = evaluate(step, response, manualInput, retry);
+        queueAnswer({
+            id: answerId(),
+            step: step,
+            response: response,
+            manual_input: manualInput,
+            retry: retry,
+            outcome: result.outcome,
+            answered_at: new Date().toISOString()
+        });
+        applyOutcome(result, step, manualInput);
+        sync();
+    }
+
+    // Send queued answers; keep them if the server cannot be reached
+    function sync() {
+        const answers = pendingAnswers();
+        if (syncing || !answers.length || !navigator.onLine) {
+            updateSyncBadge();
+            return;
+        }
+        syncing = true;
+        fetch('/sync_answers', {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ service_order: serviceOrder, answers: answers })
+        })
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                if (data.status !== 'success') {
+                    throw new Error(data.message);
+                }
+                // Answers queued while this request was in flight stay for the next sync
+                writeJson(answersKey(), pendingAnswers().slice(answers.length));
+                const disagreement = data.results.find(function(result) {
+                    return result.status === 'rejected' || result.matches_client === false;
+                });
+                if (disagreement) {
+                    alert('The server did not accept your answer to step ' + disagreement.step +
+                          (disagreement.reason ? ': ' + disagreement.reason : '') +
+                          '. The wizard will reload from the server.');
+                    writeJson(answersKey(), []);
+                    window.location.reload();
+                }
+            })
+            .catch(function(error) {
+                console.warn('Answer sync failed, will retry:', error);
+            })
+            .finally(function() {
+                syncing = false;
+                updateSyncBadge();
+                if (pendingAnswers().length && navigator.onLine) {
+                    setTimeout(sync, 5000);
+                }
+            });
+    }
+
+    function init() {
+        const container = document.getElementById('wizardStep');
+        if (!container || !window.localStorage) {
+            return;
+        }
+        serviceOrder = container.dataset.serviceOrder;
+
+        loadBundle().then(function(data) {
+            if (!data) {
+                return;
+            }
+            bundle = data;
+            // A page reloaded from the cache may be for an earlier step than the URL
+            const params = new URLSearchParams(window.location.search);
+            const urlStep = parseInt(params.get('step') || '1', 10);
+            const shown = container.querySelector('input[name="current_step"]');
+            if (bundle.steps[urlStep] && shown && parseInt(shown.value, 10) !== urlStep) {
+                goToStep(urlStep, true);
+            }
+            sync();
+        });
+
+        document.addEventListener('submit', onSubmit);
+        window.addEventListener('popstate', function(event) {
+            if (bundle && event.state && event.state.ssoeStep) {
+                goToStep(event.state.ssoeStep, true);
+            }
+        });
+        window.addEventListener('online', sync);
+        window.addEventListener('offline', updateSyncBadge);
+        updateSyncBadge();
+    }
+
+    document.addEventListener('DOMContentLoaded', init);
+
+    return { sync: sync, pendingAnswers: pendingAnswers };
+})();
@@ -19,36 +19,37 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     // Add confirmation for responses in the wizard
-    const responseButtons = document.querySelectorAll('button[name="response"]');
-    responseButtons.forEach(button => {
-        button.addEventListener('click', function(e) {
-            const currentStep = parseInt(document.querySelector('input[name="current_step"]').value);
-            const isYesResponse = button.value === 'yes';
-            
-            // For step 16, confirm only on "yes" response
-            if (currentStep === 16 && isYesResponse) {
-                if (!confirm('Are you sure you want to select "Yes"? This indicates test failures and will terminate the SSOE process.')) {
-                    e.preventDefault();
-                }
+    // (delegated, since offline.js swaps wizard steps in without a page load)
+    document.addEventListener('click', function(e) {
+        const button = e.target.closest('button[name="response"]');
+        if (!button) {
+            return;
+        }
+        const currentStep = parseInt(document.querySelector('input[name="current_step"]').value);
+        const isYesResponse = button.value === 'yes';
+        
+        // For step 16, confirm only on "yes" response
+        if (currentStep === 16 && isYesResponse) {
+            if (!confirm('Are you sure you want to select "Yes"? This indicates test failures and will terminate the SSOE process.')) {
+                e.preventDefault();
             }
-            // For all other steps, confirm on "no" response
-            else if (currentStep !== 16 && !isYesResponse) {
-                if (!confirm('Are you sure you want to select "No"? This will terminate the SSOE process.')) {
-                    e.preventDefault();
-                }
+        }
+        // For all other steps, confirm on "no" response
+        else if (currentStep !== 16 && !isYesResponse) {
+            if (!confirm('Are you sure you want to select "No"? This will terminate the SSOE process.')) {
+                e.preventDefault();
             }
-        });
+        }
     });
     
     
     // Enhance input field validation for part numbers and serial numbers
-    const manualInput = document.getElementById('manual_input');
-    if (manualInput) {
-        manualInput.addEventListener('input', function() {
+    document.addEventListener('input', function(e) {
+        if (e.target.id === 'manual_input') {
             // Convert to uppercase for consistency
-            this.value = this.value.toUpperCase();
-        });
-    }
+            e.target.value = e.target.value.toUpperCase();
+        }
+    });
 });
 
 // Function to provide visual feedback for completed steps
@@ -0,0 +1,114 @@
+// Service worker for SAP Service Order Automation
+// Keeps the wizard usable when shop-floor Wi-Fi drops out
+
+const CACHE_NAME = 'ssoe-v2';
+
+// Local assets every page loads
+const STATIC_ASSETS = [
+    '/static/css/style.css',
+    '/static/js/script.js',
+    '/static/js/offline.js',
+    '/static/manifest.webmanifest'
+];
+
+// Third-party assets loaded by base.html
+const CDN_ASSETS = [
+    'https://cdn.replit.com/agent/bootstrap-agent-dark-theme.min.css',
+    'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.bundle.min.js'
+];
+
+const CDN_HOSTS = CDN_ASSETS.map(url => new URL(url).host);
+
+// Fetch a CDN asset with CORS when the CDN allows it, otherwise store it opaque
+function fetchCdnAsset(url) {
+    return fetch(url, { mode: 'cors' })
+        .catch(() => fetch(url, { mode: 'no-cors' }));
+}
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_NAME).then(cache => Promise.all([
+            cache.addAll(STATIC_ASSETS),
+            ...CDN_ASSETS.map(url => fetchCdnAsset(url)
+                .then(response => cache.put(url, response))
+                .catch(error => console.warn('Could not precache', url, error)))
+        ])).then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    // Drop caches left by older versions of this worker
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(names
+                .filter(name => name !== CACHE_NAME)
+                .map(name => caches.delete(name))))
+            .then(() => self.clients.claim())
+    );
+});
+
+// Serve from the cache, going to the network (and caching) only on a miss
+function cacheFirst(request) {
+    return caches.match(request).then(cached => {
+        if (cached) {
+            return cached;
+        }
+        return fetch(request).then(response => {
+            if (response.ok || response.type === 'opaque') {
+                const copy = response.clone();
+                caches.open(CACHE_NAME).then(cache => cache.put(request, copy));
+            }
+            return response;
+        });
+    });
+}
+
+// Answer from the cache straight away but refresh it from the network, so a
+// deployed change to a local asset is picked up on the next load
+function staleWhileRevalidate(request) {
+    return caches.open(CACHE_NAME).then(cache => cache.match(request).then(cached => {
+        const refresh = fetch(request).then(response => {
+            if (response.ok) {
+                cache.put(request, response.clone());
+            }
+            return response;
+        });
+        if (cached) {
+            refresh.catch(() => {});
+            return cached;
+        }
+        return refresh;
+    }));
+}
+
+// Prefer fresh data, falling back to the last good copy when offline
+function networkFirst(request) {
+    return fetch(request).then(response => {
+        if (response.ok) {
+            const copy = response.clone();
+            caches.open(CACHE_NAME).then(cache => cache.put(request, copy));
+        }
+        return response;
+    }).catch(() => caches.match(request, { ignoreSearch: request.mode === 'navigate' })
+        .then(cached => cached || caches.match('/automation_wizard', { ignoreSearch: true }))
+        .then(cached => cached || Response.error()));
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') {
+        // Answers are queued by offline.js, never by the worker
+        return;
+    }
+
+    const url = new URL(request.url);
+    if (CDN_HOSTS.includes(url.host)) {
+        // CDN URLs are versioned, so a cached copy never goes out of date
+        event.respondWith(cacheFirst(request));
+    } else if (url.pathname.startsWith('/static/')) {
+        event.respondWith(staleWhileRevalidate(request));
+    } else if (request.mode === 'navigate' || url.pathname === '/wizard_bundle') {
+        event.respondWith(networkFirst(request));
+    }
+});